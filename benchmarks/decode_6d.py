@@ -0,0 +1,130 @@
+"""
+    Microbenchmark of 6DOF packet decoding: the old per-frame dict building
+    against PacketDecoder, one packet at a time and in batches. Labelled 3D
+    markers are timed the same way, per marker through the qtm SDK against
+    PacketDecoder.decode_markers_batch.
+
+    Usage: python benchmarks/decode_6d.py [--bodies 3] [--markers 8] [--frames 100000] [--batch 64]
+"""
+
+import argparse
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "new_ui"))
+
+from qtm.packet import QRTComponentType, QRTPacket
+
+from config import Config, PacketDecoder, mm_to_m
+from qtm_packets import data_packet, euler_6d_component, markers_3d_component
+
+def legacy_qtm_packet_to_lsl_sample(config, packet):
+    # qtm_packet_to_lsl_sample as it was before PacketDecoder, kept as the baseline.
+    sample = {}
+    if QRTComponentType.Component6dEuler in packet.components:
+        _, bodies = packet.get_6d_euler()
+        for body, (position, rotation) in enumerate(bodies):
+            sample[config.bodies()[body]['name']] = []
+            sample[config.bodies()[body]['name']].append(mm_to_m(position.x))
+            sample[config.bodies()[body]['name']].append(mm_to_m(position.y))
+            sample[config.bodies()[body]['name']].append(mm_to_m(position.z))
+            sample[config.bodies()[body]['name']].append(rotation.a1)
+            sample[config.bodies()[body]['name']].append(rotation.a2)
+            sample[config.bodies()[body]['name']].append(rotation.a3)
+    return sample
+
+def markers_per_marker(packet):
+    # Baseline for markers: what the SDK offers, one named tuple per marker.
+    _, markers = packet.get_3d_markers()
+    return [[mm_to_m(marker.x), mm_to_m(marker.y), mm_to_m(marker.z)] for marker in markers]
+
+def make_config(body_count, marker_count=0):
+    config = Config()
+    config.the_3d = {
+        "markers": ["marker_{}".format(index) for index in range(marker_count)],
+    }
+    config.the_6d = {
+        "bodies": [{"name": "body_{}".format(index), "points": []} for index in range(body_count)],
+        "euler": {"first": "roll", "second": "pitch", "third": "yaw"},
+    }
+    return config
+
+def make_packets(body_count, count, marker_count=0):
+    packets = []
+    for framenumber in range(count):
+        markers = []
+        for _ in range(marker_count):
+            if random.random() < 0.05:
+                markers.append((math.nan,) * 3)
+            else:
+                markers.append(tuple(random.uniform(-2000, 2000) for _ in range(3)))
+        bodies = []
+        for _ in range(body_count):
+            if random.random() < 0.05:
+                bodies.append((math.nan,) * 6)
+            else:
+                bodies.append(tuple(random.uniform(-2000, 2000) for _ in range(3))
+                    + tuple(random.uniform(-180, 180) for _ in range(3)))
+        components = [euler_6d_component(bodies)]
+        if marker_count:
+            components.insert(0, markers_3d_component(markers))
+        data = data_packet(framenumber * 10000, framenumber, components)
+        packets.append(QRTPacket(data))
+    return packets
+
+def measure(name, count, function):
+    start = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - start
+    print("{:<28} {:>12,.0f} frames/s".format(name, count / elapsed))
+    return count / elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bodies", type=int, default=3)
+    parser.add_argument("--markers", type=int, default=8)
+    parser.add_argument("--frames", type=int, default=100000)
+    parser.add_argument("--batch", type=int, default=64)
+    args = parser.parse_args()
+
+    config = make_config(args.bodies, args.markers)
+    packets = make_packets(args.bodies, args.frames, args.markers)
+    decoder = PacketDecoder(config)
+
+    def run_legacy():
+        for packet in packets:
+            legacy_qtm_packet_to_lsl_sample(config, packet)
+
+    def run_decoder():
+        for packet in packets:
+            decoder.decode(packet)
+
+    def run_batch():
+        for start in range(0, len(packets), args.batch):
+            decoder.decode_batch(packets[start:start + args.batch])
+
+    def run_markers_per_marker():
+        for packet in packets:
+            markers_per_marker(packet)
+
+    def run_markers_batch():
+        for start in range(0, len(packets), args.batch):
+            decoder.decode_markers_batch(packets[start:start + args.batch])
+
+    print("{} bodies, {} markers, {} frames".format(args.bodies, args.markers, args.frames))
+    baseline = measure("qtm_packet_to_lsl_sample", args.frames, run_legacy)
+    single = measure("PacketDecoder.decode", args.frames, run_decoder)
+    batch = measure("PacketDecoder.decode_batch", args.frames, run_batch)
+    print("speedup: decode {:.1f}x, decode_batch ({} packets) {:.1f}x".format(
+        single / baseline, args.batch, batch / baseline,
+    ))
+    if args.markers:
+        baseline = measure("3D markers, per marker", args.frames, run_markers_per_marker)
+        batch = measure("decode_markers_batch", args.frames, run_markers_batch)
+        print("speedup: decode_markers_batch ({} packets) {:.1f}x".format(args.batch, batch / baseline))
+
+if __name__ == "__main__":
+    main()
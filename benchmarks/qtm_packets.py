@@ -0,0 +1,41 @@
+"""
+    Build raw QTM real-time data packets for benchmarks and the simulated QTM server.
+"""
+
+import struct
+
+from qtm.packet import (
+    QRTComponentType,
+    RT3DComponent,
+    RT6DComponent,
+    RTComponentData,
+    RTDataQRTPacket,
+)
+
+EULER_BODY = struct.Struct("<6f")
+MARKER = struct.Struct("<3f")
+
+def component(component_type, payload):
+    return RTComponentData.pack(RTComponentData.size + len(payload), component_type.value) + payload
+
+def euler_6d_component(bodies):
+    """
+        bodies is a sequence of (x, y, z, a1, a2, a3) tuples, positions in mm.
+    """
+    payload = RT6DComponent.format.pack(len(bodies), 0, 0)
+    payload += b"".join(EULER_BODY.pack(*body) for body in bodies)
+    return component(QRTComponentType.Component6dEuler, payload)
+
+def markers_3d_component(markers):
+    """
+        markers is a sequence of (x, y, z) tuples in mm.
+    """
+    payload = RT3DComponent.format.pack(len(markers), 0, 0)
+    payload += b"".join(MARKER.pack(*marker) for marker in markers)
+    return component(QRTComponentType.Component3d, payload)
+
+def data_packet(timestamp, framenumber, components):
+    """
+        Payload of a QTM data packet, i.e. what qtm.QRTPacket is constructed from.
+    """
+    return RTDataQRTPacket.pack(timestamp, framenumber, len(components)) + b"".join(components)
@@ -0,0 +1,244 @@
+"""
+    Local stand-in for the QTM real-time server, for exercising MocapRecorder without a QTM install.
+
+    Speaks the parts of the QTM RT protocol the recorder uses (version, getstate,
+    getparameters, streamframes) and streams synthetic 6DOF Euler and labelled 3D
+    frames at a fixed frequency, with optional dropped frames and disconnects.
+
+    Usage: python benchmarks/qtm_simulator.py [--port 22223] [--frequency 100] [--bodies 3] [--markers 8]
+"""
+
+import argparse
+import asyncio
+import logging
+import math
+import random
+import struct
+import time
+
+from qtm.packet import QRTEvent, QRTPacketType, RTheader
+
+from qtm_packets import data_packet, euler_6d_component, markers_3d_component
+
+LOG = logging.getLogger("qtm_simulator")
+DEFAULT_PORT = 22223
+DEFAULT_BODY_NAMES = ["skate_small", "skate_big", "mother"]
+
+def packet(packet_type, payload):
+    return RTheader.pack(RTheader.size + len(payload), packet_type.value) + payload
+
+def string_packet(packet_type, text):
+    return packet(packet_type, text.encode("utf-8") + b"\0")
+
+def event_packet(event):
+    return packet(QRTPacketType.PacketEvent, struct.pack("<B", event.value))
+
+class SimulatorSettings:
+    def __init__(self, frequency=100, body_count=3, marker_count=8, occlusion_rate=0.02,
+            drop_rate=0.0, disconnect_after=None, state_event=QRTEvent.EventConnected):
+        self.frequency = frequency
+        self.body_names = [
+            DEFAULT_BODY_NAMES[index] if index < len(DEFAULT_BODY_NAMES) else "body_{}".format(index)
+            for index in range(body_count)
+        ]
+        self.marker_names = ["marker_{}".format(index) for index in range(marker_count)]
+        self.occlusion_rate = occlusion_rate
+        self.drop_rate = drop_rate
+        self.disconnect_after = disconnect_after
+        self.state_event = state_event
+
+    def parameters_xml(self):
+        cameras = "".join(
+            "<Camera><ID>{0}</ID><Model>Simulated</Model><Serial>{0}</Serial><Mode>Marker</Mode>"
+            "<Video_Frequency>{1}</Video_Frequency><Position><X>{2}</X><Y>{3}</Y><Z>2000</Z></Position></Camera>"
+            .format(index + 1, self.frequency, 3000 * math.cos(index), 3000 * math.sin(index))
+            for index in range(4)
+        )
+        labels = "".join("<Label><Name>{}</Name></Label>".format(name) for name in self.marker_names)
+        bodies = "".join(
+            "<Body><Name>{}</Name><Point><X>0</X><Y>0</Y><Z>0</Z></Point></Body>".format(name)
+            for name in self.body_names
+        )
+        return (
+            "<QTM_Parameters_Ver_1.19>"
+            "<General><Frequency>{}</Frequency>{}</General>"
+            "<The_3D>{}</The_3D>"
+            "<The_6D>{}<Euler><First>roll</First><Second>pitch</Second><Third>yaw</Third></Euler></The_6D>"
+            "</QTM_Parameters_Ver_1.19>"
+        ).format(self.frequency, cameras, labels, bodies)
+
+class SyntheticMotion:
+    """
+        Bodies skate in circles and slowly turn, markers follow them. A small
+        share of bodies and markers are occluded (NaN) in each frame.
+    """
+    def __init__(self, settings):
+        self.settings = settings
+
+    def occluded(self):
+        return random.random() < self.settings.occlusion_rate
+
+    def bodies(self, t):
+        bodies = []
+        for index in range(len(self.settings.body_names)):
+            if self.occluded():
+                bodies.append((math.nan,) * 6)
+                continue
+            phase = 0.3 * t + index
+            yaw = math.degrees(math.atan2(math.cos(phase), -math.sin(phase)))
+            bodies.append((1500 * math.cos(phase), 1500 * math.sin(phase), 100.0, 0.0, 0.0, yaw))
+        return bodies
+
+    def markers(self, t):
+        markers = []
+        for index in range(len(self.settings.marker_names)):
+            if self.occluded():
+                markers.append((math.nan,) * 3)
+                continue
+            phase = 0.3 * t + index / 4
+            markers.append((1500 * math.cos(phase), 1500 * math.sin(phase), 20.0 * (index % 4)))
+        return markers
+
+class SimulatorProtocol(asyncio.Protocol):
+    def __init__(self, settings):
+        self.settings = settings
+        self.motion = SyntheticMotion(settings)
+        self.transport = None
+        self.buffer = b""
+        self.stream_task = None
+        self.disconnect_handle = None
+        self.frames_sent = 0
+        self.frames_dropped = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.transport.write(string_packet(QRTPacketType.PacketCommand, "QTM RT Interface connected"))
+        if self.settings.disconnect_after:
+            loop = asyncio.get_event_loop()
+            self.disconnect_handle = loop.call_later(self.settings.disconnect_after, self.transport.close)
+        LOG.info("client connected")
+
+    def connection_lost(self, exc):
+        self.stop_streaming()
+        if self.disconnect_handle:
+            self.disconnect_handle.cancel()
+        LOG.info("client disconnected, {} frames sent, {} dropped".format(self.frames_sent, self.frames_dropped))
+
+    def data_received(self, data):
+        self.buffer += data
+        while len(self.buffer) >= RTheader.size:
+            size, _ = RTheader.unpack_from(self.buffer, 0)
+            if len(self.buffer) < size:
+                break
+            command = self.buffer[RTheader.size:size].rstrip(b"\0").decode("utf-8")
+            self.buffer = self.buffer[size:]
+            self.on_command(command)
+
+    def send(self, data):
+        if self.transport and not self.transport.is_closing():
+            self.transport.write(data)
+
+    def on_command(self, command):
+        LOG.debug("command: %s", command)
+        words = command.lower().split()
+        if not words:
+            return
+        if words[0] == "version":
+            self.send(string_packet(QRTPacketType.PacketCommand, "Version set to {}".format(words[1])))
+        elif words[0] == "getstate":
+            self.send(event_packet(self.settings.state_event))
+        elif words[0] == "getparameters":
+            self.send(string_packet(QRTPacketType.PacketXML, self.settings.parameters_xml()))
+        elif words[0] == "streamframes" and words[1:] == ["stop"]:
+            self.stop_streaming()
+        elif words[0] == "streamframes":
+            components = [word for word in words[2:] if word in ["3d", "6deuler"]]
+            if len(components) != len(words[2:]):
+                self.send(string_packet(QRTPacketType.PacketError, "Unsupported component in '{}'".format(command)))
+                return
+            self.stop_streaming()
+            self.stream_task = asyncio.ensure_future(self.stream(components))
+        else:
+            self.send(string_packet(QRTPacketType.PacketError, "Unknown command '{}'".format(command)))
+
+    def stop_streaming(self):
+        if self.stream_task:
+            self.stream_task.cancel()
+            self.stream_task = None
+
+    def frame(self, framenumber, components):
+        t = framenumber / self.settings.frequency
+        parts = []
+        for component in components:
+            if component == "3d":
+                parts.append(markers_3d_component(self.motion.markers(t)))
+            else:
+                parts.append(euler_6d_component(self.motion.bodies(t)))
+        timestamp = int(framenumber * 1e6 / self.settings.frequency)
+        return packet(QRTPacketType.PacketData, data_packet(timestamp, framenumber, parts))
+
+    async def stream(self, components):
+        # Frames are due at absolute times, so a late wakeup sends the frames
+        # it missed instead of drifting behind the nominal frequency.
+        period = 1 / self.settings.frequency
+        start = time.perf_counter()
+        framenumber = 0
+        while True:
+            due = int((time.perf_counter() - start) / period) + 1
+            frames = []
+            while framenumber < due:
+                if random.random() < self.settings.drop_rate:
+                    self.frames_dropped += 1
+                else:
+                    frames.append(self.frame(framenumber, components))
+                framenumber += 1
+            if frames:
+                self.send(b"".join(frames))
+                self.frames_sent += len(frames)
+            await asyncio.sleep(max(0, start + framenumber * period - time.perf_counter()))
+
+async def serve(settings, host="127.0.0.1", port=DEFAULT_PORT):
+    loop = asyncio.get_event_loop()
+    server = await loop.create_server(lambda: SimulatorProtocol(settings), host, port)
+    LOG.info("simulated QTM listening on {}:{}".format(host, port))
+    return server
+
+def add_arguments(parser):
+    parser.add_argument("--frequency", type=float, default=100, help="frames per second")
+    parser.add_argument("--bodies", type=int, default=3, help="number of 6DOF bodies")
+    parser.add_argument("--markers", type=int, default=8, help="number of labelled 3D markers")
+    parser.add_argument("--occlusion-rate", type=float, default=0.02, help="share of occluded bodies/markers")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="share of frames never sent")
+    parser.add_argument("--disconnect-after", type=float, default=None, help="close each connection after this many seconds")
+
+def settings_from_arguments(args):
+    return SimulatorSettings(
+        frequency=args.frequency,
+        body_count=args.bodies,
+        marker_count=args.markers,
+        occlusion_rate=args.occlusion_rate,
+        drop_rate=args.drop_rate,
+        disconnect_after=args.disconnect_after,
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    add_arguments(parser)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = loop.run_until_complete(serve(settings_from_arguments(args), args.host, args.port))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        loop.close()
+
+if __name__ == "__main__":
+    main()
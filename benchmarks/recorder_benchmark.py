@@ -0,0 +1,163 @@
+"""
+    Run the mocap recorder against the simulated QTM server and report sustained throughput, CPU and memory.
+
+    The simulator runs in a child process so the CPU and memory figures are the recorder's own.
+
+    Usage: python benchmarks/recorder_benchmark.py [--duration 10] [--frequency 1000] [--bodies 3] [--markers 8]
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak memory is then not reported.
+    resource = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "new_ui"))
+
+import mocap_recording
+from mocap_recording import State
+
+from qtm_simulator import add_arguments
+
+SIMULATOR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "qtm_simulator.py")
+
+def peak_memory_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere.
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+def start_simulator(args):
+    command = [
+        sys.executable, SIMULATOR,
+        "--port", str(args.port),
+        "--frequency", str(args.frequency),
+        "--bodies", str(args.bodies),
+        "--markers", str(args.markers),
+        "--occlusion-rate", str(args.occlusion_rate),
+        "--drop-rate", str(args.drop_rate),
+    ]
+    if args.disconnect_after:
+        command += ["--disconnect-after", str(args.disconnect_after)]
+    return subprocess.Popen(command)
+
+async def connect(args, on_state_changed, on_error, filepath):
+    # The simulator needs a moment to start listening.
+    deadline = time.time() + 10
+    while True:
+        try:
+            return await mocap_recording.init(
+                "127.0.0.1",
+                args.port,
+                on_state_changed=on_state_changed,
+                on_error=on_error,
+                starting_yaw=0,
+                filepath=filepath,
+                stream_markers=args.stream_markers,
+                lsl_streams=args.lsl_streams,
+            )
+        except mocap_recording.LinkError:
+            if time.time() > deadline:
+                raise
+            await asyncio.sleep(0.2)
+
+async def run(args, filepath):
+    streaming = asyncio.Event()
+    errors = []
+
+    def on_state_changed(state):
+        if state == State.STREAMING:
+            streaming.set()
+
+    recorder = await connect(args, on_state_changed, errors.append, filepath)
+    await asyncio.wait_for(streaming.wait(), timeout=10)
+
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    packets_start = recorder.packet_count
+    while time.perf_counter() - wall_start < args.duration and recorder.is_streaming():
+        await asyncio.sleep(0.1)
+    wall_time = time.perf_counter() - wall_start
+    cpu_time = time.process_time() - cpu_start
+    packet_count = recorder.packet_count - packets_start
+
+    shutdown_start = time.perf_counter()
+    await recorder.shutdown()
+    shutdown_time = time.perf_counter() - shutdown_start
+
+    return {
+        "frames": packet_count,
+        "wall_time": wall_time,
+        "frames_per_second": packet_count / wall_time,
+        "cpu_percent": 100 * cpu_time / wall_time,
+        "shutdown_time": shutdown_time,
+        "peak_memory_mb": peak_memory_mb(),
+        "receiver_stats": recorder.receiver_stats,
+        "latency": recorder.latency.summary(),
+        "frame_gaps": recorder.frame_gaps.summary(),
+        "errors": errors,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--duration", type=float, default=10, help="seconds to record")
+    parser.add_argument("--port", type=int, default=22299)
+    parser.add_argument("--keep", action="store_true", help="keep the recorded trial files")
+    parser.add_argument("--stream-markers", action="store_true", help="publish 3D markers on the LSL data stream")
+    parser.add_argument("--lsl-streams", nargs="*", default=[], metavar="NAME",
+        help="also record these LSL streams, e.g. from an EEG amplifier")
+    add_arguments(parser)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    # config.py turns on debug logging for the recorder, which would dominate the measurement.
+    logging.getLogger("qlsl").setLevel(logging.WARNING)
+
+    simulator = start_simulator(args)
+    output_folder = tempfile.mkdtemp(prefix="recorder_benchmark_")
+    try:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        result = loop.run_until_complete(run(args, os.path.join(output_folder, "trial_1")))
+        loop.close()
+    finally:
+        simulator.terminate()
+        simulator.wait()
+
+    print("{} Hz, {} bodies, {} markers, {:.1f} s".format(args.frequency, args.bodies, args.markers, result["wall_time"]))
+    print("  frames recorded     {:>10}".format(result["frames"]))
+    print("  sustained frames/s  {:>10.0f}".format(result["frames_per_second"]))
+    print("  recorder CPU        {:>9.1f}%".format(result["cpu_percent"]))
+    if result["peak_memory_mb"] is not None:
+        print("  peak memory         {:>8.1f} MB".format(result["peak_memory_mb"]))
+    print("  shutdown            {:>8.3f} s".format(result["shutdown_time"]))
+    stats = result["receiver_stats"]
+    print("  queue high water    {:>10}".format(stats.queue_high_water_mark))
+    print("  queue dropped       {:>10}".format(stats.dropped_count))
+    print("  mean batch size     {:>10.1f}".format(stats.mean_batch_size()))
+    gaps = result["frame_gaps"]
+    print("  frames missing      {:>10} ({} gaps)".format(gaps["frames_missing"], gaps["gap_count"]))
+    decoded = result["latency"]["arrival_to_decoded"]
+    if decoded["count"]:
+        print("  arrival to decoded  p50 {:.2e} s, p99 {:.2e} s".format(decoded["p50"], decoded["p99"]))
+    for error in result["errors"]:
+        print("  error: {}".format(error))
+
+    if args.keep:
+        print("Trial files in {}".format(output_folder))
+    else:
+        for filename in os.listdir(output_folder):
+            os.remove(os.path.join(output_folder, filename))
+        os.rmdir(output_folder)
+
+if __name__ == "__main__":
+    main()
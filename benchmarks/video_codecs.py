@@ -0,0 +1,106 @@
+"""
+    Encode the same synthetic camera frames with every codec in
+    trial_camera.VIDEO_CODECS and report encode frames/second, CPU time per
+    frame and file size, to choose VIDEO_CODEC in new_gui.py. No camera is
+    needed; codecs the local OpenCV build cannot write are reported as such.
+
+    Usage: python benchmarks/video_codecs.py [--width 1280] [--height 720] [--fps 30] [--frames 300] [--codecs mp4v mjpg]
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "new_ui"))
+
+from trial_camera import VIDEO_CODECS, open_video_writer
+
+# Distinct frames generated, the disc goes round once per cycle. Keeps
+# memory at about 170 MB for 720p however many frames are encoded.
+CYCLE_FRAMES = 60
+
+def make_frames(width, height, count, seed=0):
+    """
+        A still background with a textured disc moving across it and a little
+        sensor noise, closer to a room camera than random pixels, which no
+        codec can compress. Frames are BGR uint8 like cv2.VideoCapture delivers.
+    """
+    random = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    background = np.stack([
+        (x * 255 // max(width - 1, 1)),
+        (y * 255 // max(height - 1, 1)),
+        np.full_like(x, 96),
+    ], axis=-1).astype(np.uint8)
+    texture = random.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    radius = min(width, height) // 6
+    frames = []
+    for index in range(count):
+        angle = 2 * np.pi * index / max(count, 1)
+        center_x = width / 2 + width / 3 * np.cos(angle)
+        center_y = height / 2 + height / 3 * np.sin(angle)
+        disc = (x - center_x) ** 2 + (y - center_y) ** 2 < radius ** 2
+        frame = background.copy()
+        frame[disc] = texture[disc]
+        noise = random.integers(-4, 5, frame.shape, dtype=np.int16)
+        frames.append(np.clip(frame + noise, 0, 255).astype(np.uint8))
+    return frames
+
+def measure(name, codec, frames, frame_count, fps, folder):
+    height, width = frames[0].shape[:2]
+    filepath = os.path.join(folder, "benchmark_" + name + codec.extension)
+    try:
+        writer = open_video_writer(filepath, codec, fps, (width, height))
+    except RuntimeError:
+        return None
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    for index in range(frame_count):
+        writer.write(frames[index % len(frames)])
+    writer.release()
+    wall_time = time.perf_counter() - wall_start
+    cpu_time = time.process_time() - cpu_start
+    size = os.path.getsize(filepath)
+    return {
+        "frames_per_second": frame_count / wall_time,
+        "cpu_ms_per_frame": 1000 * cpu_time / frame_count,
+        "size_mb": size / 2**20,
+        "mb_per_minute": size / 2**20 * 60 * fps / frame_count,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--height", type=int, default=720)
+    parser.add_argument("--fps", type=float, default=30)
+    parser.add_argument("--frames", type=int, default=300)
+    parser.add_argument("--codecs", nargs="*", default=list(VIDEO_CODECS), choices=list(VIDEO_CODECS))
+    parser.add_argument("--keep", action="store_true", help="keep the encoded files")
+    args = parser.parse_args()
+
+    frames = make_frames(args.width, args.height, min(args.frames, CYCLE_FRAMES))
+    folder = tempfile.mkdtemp(prefix="video_codecs_")
+    print("{}x{}, {} frames at {} fps".format(args.width, args.height, args.frames, args.fps))
+    print("{:<6} {:>10} {:>14} {:>10} {:>10}".format("codec", "frames/s", "CPU ms/frame", "MB", "MB/min"))
+    try:
+        for name in args.codecs:
+            result = measure(name, VIDEO_CODECS[name], frames, args.frames, args.fps, folder)
+            if result is None:
+                print("{:<6} not available in this OpenCV build".format(name))
+                continue
+            print("{:<6} {:>10.0f} {:>14.2f} {:>10.1f} {:>10.1f}".format(
+                name, result["frames_per_second"], result["cpu_ms_per_frame"], result["size_mb"], result["mb_per_minute"],
+            ))
+    finally:
+        if args.keep:
+            print("Encoded files in {}".format(folder))
+        else:
+            shutil.rmtree(folder, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
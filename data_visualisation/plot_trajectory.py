@@ -1,29 +1,57 @@
-import csv
 import matplotlib.pyplot as plt
 import numpy as np
 from matplotlib.widgets import Slider, TextBox
 import matplotlib.patches as patches
 import tkinter as tk
 from tkinter import filedialog
-import datetime
+import os
 
-def load_data(filepath):
-    timestamps = []
-    x = []
-    y = []
-    yaw = []
+CHANNELS = ['x', 'y', 'z', 'roll', 'pitch', 'yaw']
+CACHE_VERSION = 1
+
+def cache_filepath(filepath):
+    return filepath + ".cache.npz"
 
+def parse_trial_csv(filepath):
+    # Numbers in bulk with loadtxt, timestamps by numpy's ISO 8601 parser instead of strptime per row.
+    values = np.loadtxt(filepath, delimiter=',', skiprows=1, usecols=range(1, len(CHANNELS) + 1), ndmin=2)
     with open(filepath, 'r') as data_file:
-        data_reader = csv.reader(data_file)
-        next(data_reader)
-        for row in data_reader:
-            timestamps.append(datetime.datetime.strptime(row[0][:-2], "%Y-%m-%dT%H:%M:%S.%f"))
-            x.append(float(row[1]))
-            y.append(float(row[2]))
-            yaw.append(float(row[6]))
-        
-        timestamps = [round((timestamp - timestamps[0]).total_seconds(), 2) for timestamp in timestamps]
-        return np.array(timestamps), np.array(x), np.array(y), np.array(yaw)
+        next(data_file)
+        timestamps = np.array([line.partition(',')[0] for line in data_file if line.strip()], dtype='datetime64[us]')
+    return timestamps, values
+
+def load_trial_csv(filepath):
+    """
+        Timestamps as datetime64[us] and the six channels as float columns,
+        shape (frames, 6). The parsed arrays are cached next to the CSV file
+        and reused as long as its size and modification time are unchanged.
+    """
+    stat = os.stat(filepath)
+    key = np.array([CACHE_VERSION, stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+    try:
+        with np.load(cache_filepath(filepath)) as cache:
+            if np.array_equal(cache['key'], key):
+                return cache['timestamps'], cache['values']
+    except (OSError, KeyError, ValueError):
+        pass
+    timestamps, values = parse_trial_csv(filepath)
+    try:
+        with open(cache_filepath(filepath), 'wb') as cache_file:
+            np.savez(cache_file, key=key, timestamps=timestamps, values=values)
+    except OSError:
+        pass
+    return timestamps, values
+
+def load_data(filepath):
+    timestamps, values = load_trial_csv(filepath)
+    # Seconds since the first sample from millisecond timestamps, rounded to
+    # 10 ms for the slider, as before.
+    milliseconds = timestamps.astype('datetime64[ms]')
+    seconds = np.round((milliseconds - milliseconds[0]) / np.timedelta64(1, 's'), 2)
+    x = values[:, CHANNELS.index('x')]
+    y = values[:, CHANNELS.index('y')]
+    yaw = values[:, CHANNELS.index('yaw')]
+    return seconds, x, y, yaw
     
 
 def open_file_dialog():
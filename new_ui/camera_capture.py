@@ -0,0 +1,134 @@
+"""
+    Read camera frames on a background thread into a small ring of the latest frames.
+"""
+
+from collections import deque, namedtuple
+import logging
+import threading
+
+from pylsl import local_clock
+
+LOG = logging.getLogger("qlsl")
+
+CAPTURE_RING_SIZE = 8
+# Frame times kept for the measured frame rate.
+FPS_SAMPLES = 60
+RETRY_INTERVAL = 0.5
+STOP_TIMEOUT = 2
+
+# index counts every frame captured, time is when it was grabbed on the LSL
+# clock, image is the frame as the camera delivers it (BGR).
+CapturedFrame = namedtuple("CapturedFrame", "index time image")
+
+class FrameRing:
+    """
+        Thread-safe ring of the most recent frames and their times, read by
+        the preview through latest() and for the measured frame rate.
+    """
+    def __init__(self, size=CAPTURE_RING_SIZE):
+        self.frames = deque(maxlen=size)
+        self.times = deque(maxlen=FPS_SAMPLES)
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def push(self, time, image):
+        with self.lock:
+            frame = CapturedFrame(self.count, time, image)
+            self.frames.append(frame)
+            self.times.append(time)
+            self.count += 1
+        return frame
+
+    def latest(self):
+        with self.lock:
+            return self.frames[-1] if self.frames else None
+
+    def fps(self):
+        with self.lock:
+            if len(self.times) < 2 or self.times[-1] == self.times[0]:
+                return None
+            return (len(self.times) - 1) / (self.times[-1] - self.times[0])
+
+class CameraCapture:
+    """
+        Grabs frames as fast as the camera delivers them, so the frame rate
+        no longer depends on how busy the GUI is. open_capture() returns a
+        cv2.VideoCapture (or anything with isOpened, grab, retrieve and
+        release) and is called on the capture thread, since opening a camera
+        can take seconds.
+
+        Each frame is stamped right after grab() returns, before it is decoded.
+
+        Consumers that need every frame, like the video encoder, are called
+        with each CapturedFrame on the capture thread and must not block.
+    """
+    def __init__(self, open_capture, ring_size=CAPTURE_RING_SIZE, clock=local_clock, name="camera"):
+        self.open_capture = open_capture
+        self.ring = FrameRing(ring_size)
+        self.clock = clock
+        self.name = name
+        self.failed_reads = 0
+        # Replaced rather than modified, so the capture thread can iterate it without a lock.
+        self.consumers = []
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name=self.name, daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=STOP_TIMEOUT):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join(timeout)
+            self.thread = None
+
+    def add_consumer(self, consumer):
+        self.consumers = self.consumers + [consumer]
+
+    def remove_consumer(self, consumer):
+        self.consumers = [other for other in self.consumers if other != consumer]
+
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def latest(self):
+        return self.ring.latest()
+
+    def fps(self):
+        return self.ring.fps()
+
+    def frame_size(self):
+        # (width, height) of the frames captured so far, None before the first one.
+        frame = self.ring.latest()
+        if frame is None:
+            return None
+        height, width = frame.image.shape[:2]
+        return width, height
+
+    def run(self):
+        capture = None
+        try:
+            capture = self.open_capture()
+            if not capture.isOpened():
+                LOG.error("{}: could not be opened".format(self.name))
+                return
+            while not self.stop_event.is_set():
+                if not capture.grab():
+                    self.failed_reads += 1
+                    self.stop_event.wait(RETRY_INTERVAL)
+                    continue
+                time = self.clock()
+                ok, image = capture.retrieve()
+                if ok:
+                    frame = self.ring.push(time, image)
+                    for consumer in self.consumers:
+                        consumer(frame)
+                else:
+                    self.failed_reads += 1
+        except Exception as ex:
+            LOG.error("{}: capture exception: ".format(self.name) + repr(ex))
+        finally:
+            if capture is not None:
+                capture.release()
+            LOG.debug("{}: capture stopped".format(self.name))
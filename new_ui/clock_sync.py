@@ -0,0 +1,135 @@
+"""
+    Map QTM frame timestamps onto the LSL clock, with a per-trial sidecar of the fit.
+"""
+
+import json
+
+import numpy as np
+
+# Arrivals are reduced to their fastest frame per bucket of QTM time, the
+# online fit uses the most recent WINDOW_BUCKETS of them.
+BUCKET_SECONDS = 1.0
+WINDOW_BUCKETS = 120
+# Bucket minima further than this many median absolute deviations off the first fit are dropped.
+OUTLIER_MADS = 3
+MIN_OUTLIER_RESIDUAL = 1e-5
+
+def clock_sync_filepath(filepath):
+    return f"{filepath}_clock.json"
+
+def robust_line(x, y):
+    """
+        Least squares line y = intercept + slope * x, fitted again without
+        the outliers of the first fit. Returns (intercept, slope).
+    """
+    slope, intercept = np.polyfit(x, y, 1)
+    residuals = y - (intercept + slope * x)
+    deviations = np.abs(residuals - np.median(residuals))
+    threshold = max(OUTLIER_MADS * float(np.median(deviations)), MIN_OUTLIER_RESIDUAL)
+    inliers = deviations <= threshold
+    if 2 <= np.count_nonzero(inliers) < len(x):
+        slope, intercept = np.polyfit(x[inliers], y[inliers], 1)
+    return float(intercept), float(slope)
+
+class QtmClock:
+    """
+        QTM timestamps (microseconds since QTM started capturing) are unrelated
+        to pylsl.local_clock(), and the two clocks drift apart slowly. The
+        offset arrival - capture of each frame is the clock offset plus the
+        delay of that frame, so the frames that arrived fastest trace the
+        clock offset: the fastest frame of every bucket is kept, and a robust
+        line through them gives offset and drift.
+
+        Until two buckets are complete the smallest offset seen is used.
+    """
+    def __init__(self, bucket_seconds=BUCKET_SECONDS, window_buckets=WINDOW_BUCKETS):
+        self.bucket_seconds = bucket_seconds
+        self.window_buckets = window_buckets
+        # QTM time (s) of the first frame, the fit is relative to it for precision.
+        self.reference = None
+        # Fastest frame of each completed bucket as (QTM time - reference, offset), and of the current one.
+        self.points = []
+        self.current_bucket = None
+        self.current_point = None
+        self.min_offset = None
+        self.intercept = None
+        self.slope = 0.0
+
+    def update(self, qtm_timestamps, arrival_times):
+        qtm_times = np.asarray(qtm_timestamps, dtype=np.float64) / 1e6
+        if qtm_times.size == 0:
+            return
+        offsets = np.asarray(arrival_times, dtype=np.float64) - qtm_times
+        if self.reference is None:
+            self.reference = float(qtm_times[0])
+        batch_min = float(offsets.min())
+        if self.min_offset is None or batch_min < self.min_offset:
+            self.min_offset = batch_min
+
+        times = qtm_times - self.reference
+        buckets = np.floor(times / self.bucket_seconds).astype(np.int64)
+        completed = False
+        for bucket in np.unique(buckets).tolist():
+            in_bucket = np.flatnonzero(buckets == bucket)
+            fastest = in_bucket[np.argmin(offsets[in_bucket])]
+            point = (float(times[fastest]), float(offsets[fastest]))
+            if self.current_bucket is None or bucket > self.current_bucket:
+                if self.current_point is not None:
+                    self.points.append(self.current_point)
+                    completed = True
+                self.current_bucket = bucket
+                self.current_point = point
+            elif bucket == self.current_bucket and point[1] < self.current_point[1]:
+                self.current_point = point
+            # Stragglers from completed buckets are left out.
+        if completed:
+            self.fit(self.points[-self.window_buckets:])
+
+    def fit(self, points):
+        if len(points) < 2:
+            return
+        x, y = np.array(points).T
+        self.intercept, self.slope = robust_line(x, y)
+
+    def offset_at(self, qtm_times):
+        if self.intercept is None:
+            return np.full(np.shape(qtm_times), self.min_offset)
+        return self.intercept + self.slope * (qtm_times - self.reference)
+
+    def to_lsl(self, qtm_timestamps):
+        qtm_times = np.asarray(qtm_timestamps, dtype=np.float64) / 1e6
+        return qtm_times + self.offset_at(qtm_times)
+
+    def all_points(self):
+        if self.current_point is None:
+            return list(self.points)
+        return self.points + [self.current_point]
+
+    def save(self, filepath):
+        with open(filepath, 'w') as file:
+            json.dump({
+                "unit": "seconds",
+                "bucket_seconds": self.bucket_seconds,
+                "reference": self.reference,
+                "intercept": self.intercept,
+                "slope": self.slope,
+                "min_offset": self.min_offset,
+                "points": self.all_points(),
+            }, file)
+
+    @classmethod
+    def load(cls, filepath):
+        """
+            Rebuild the clock saved with a trial, fitted over the whole trial
+            instead of the recent window used while recording.
+        """
+        with open(filepath) as file:
+            saved = json.load(file)
+        clock = cls(saved["bucket_seconds"])
+        clock.reference = saved["reference"]
+        clock.min_offset = saved["min_offset"]
+        clock.points = [tuple(point) for point in saved["points"]]
+        clock.intercept = saved["intercept"]
+        clock.slope = saved["slope"]
+        clock.fit(clock.points)
+        return clock
@@ -3,10 +3,12 @@
 """
 
 import logging
+import struct
 import xml.etree.ElementTree as ET
 
-from pylsl import cf_int32, StreamInfo
-from qtm.packet import QRTComponentType
+import numpy as np
+from pylsl import cf_float32, cf_int32, StreamInfo
+from qtm.packet import QRTComponentType, RT3DComponent, RT6DComponent
 
 LOG = logging.getLogger("qlsl")
 LOG.setLevel(logging.DEBUG)
@@ -45,8 +47,7 @@ class Config:
         return len(self.cameras())
 
     def channel_count(self):
-        return 6*self.body_count()
-        # return 3*self.marker_count() + 6*self.body_count()
+        return 3*self.marker_count() + 6*self.body_count()
 
 def parse_qtm_parameters(xml_string):
     xml = ET.fromstring(xml_string)
@@ -129,44 +130,173 @@ def mm_to_m(mm):
     return round(mm/1000, 6)
 
 # Note: 
-# Changes in channel metadata should be reflected in qtm_packet_to_lsl_sample,
+# Changes in channel metadata should be reflected in PacketDecoder,
 # and vice versa. 
 
-def qtm_packet_to_lsl_sample(config, packet):
-    sample = {}
-    if QRTComponentType.Component6dEuler in packet.components:
-        _, bodies = packet.get_6d_euler()
-        for body, (position, rotation) in enumerate(bodies):
-            sample[config.bodies()[body]['name']] = []
-            sample[config.bodies()[body]['name']].append(mm_to_m(position.x))
-            sample[config.bodies()[body]['name']].append(mm_to_m(position.y))
-            sample[config.bodies()[body]['name']].append(mm_to_m(position.z))
-            sample[config.bodies()[body]['name']].append(rotation.a1)
-            sample[config.bodies()[body]['name']].append(rotation.a2)
-            sample[config.bodies()[body]['name']].append(rotation.a3)
-    return sample
+# Each 6DOF Euler body is x, y, z (mm) followed by the three Euler angles (degrees), all float32.
+EULER_BODY_DTYPE = np.dtype('<f4')
+EULER_BODY_VALUES = 6
+# Each labelled 3D marker is x, y, z (mm) as float32, NaN when occluded.
+MARKER_DTYPE = np.dtype('<f4')
+MARKER_VALUES = 3
+
+def mm_to_m_array(positions):
+    # In place version of mm_to_m. np.round breaks ties on the rounded
+    # product, round() on the exact value, so ties use round().
+    np.divide(positions, 1000, out=positions)
+    scaled = positions * 1e6
+    rounded = np.rint(scaled)
+    ties = np.abs(scaled - rounded) == 0.5
+    tied_positions = positions[ties] if ties.any() else None
+    np.divide(rounded, 1e6, out=positions)
+    if tied_positions is not None:
+        positions[ties] = [round(m, 6) for m in tied_positions.tolist()]
+    return positions
+
+class PacketDecoder:
+    """
+        Decodes the 6DOF Euler component of QTM packets into (bodies, 6)
+        float64 frames, and the 3D component into (markers, 3) frames, with
+        positions in meters. Built once per stream, so the body and marker
+        layout is resolved up front instead of for every frame.
+    """
+    def __init__(self, config):
+        self.marker_names = list(config.markers())
+        self.marker_count = len(self.marker_names)
+        self.marker_bytes = self.marker_count * MARKER_VALUES * MARKER_DTYPE.itemsize
+        self.body_names = [body["name"] for body in config.bodies()]
+        self.body_count = len(self.body_names)
+        self.body_values = self.body_count * EULER_BODY_VALUES
+        self.body_bytes = self.body_values * EULER_BODY_DTYPE.itemsize
+        self.body_struct = struct.Struct("<{}f".format(self.body_values))
+        self.position_indices = [
+            index for index in range(self.body_values) if index % EULER_BODY_VALUES < 3
+        ]
+        self.frame = np.empty((self.body_count, EULER_BODY_VALUES), dtype=np.float64)
+
+    def body_data_offset(self, packet):
+        # Offset of the first body in packet.data, or None if the packet does
+        # not carry 6DOF Euler data for exactly the bodies in the config.
+        position = packet.components.get(QRTComponentType.Component6dEuler)
+        if position is None:
+            return None
+        body_count, _, _ = RT6DComponent.format.unpack_from(packet.data, position)
+        if body_count != self.body_count:
+            return None
+        return position + RT6DComponent.format.size
+
+    def marker_data_offset(self, packet):
+        # Offset of the first marker in packet.data, or None if the packet does
+        # not carry 3D data for exactly the markers in the config.
+        position = packet.components.get(QRTComponentType.Component3d)
+        if position is None:
+            return None
+        marker_count, _, _ = RT3DComponent.format.unpack_from(packet.data, position)
+        if marker_count != self.marker_count:
+            return None
+        return position + RT3DComponent.format.size
+
+    def convert(self, frames):
+        # Positions from mm to m, rounded like mm_to_m.
+        mm_to_m_array(frames[..., :3])
+        return frames
+
+    def decode(self, packet, out=None):
+        """
+            Decode one packet into out (default: the decoder's own frame, which
+            is overwritten by the next call). Returns None for unusable packets.
+        """
+        offset = self.body_data_offset(packet)
+        if offset is None:
+            return None
+        if out is None:
+            out = self.frame
+        # For a single frame plain floats beat the per-call overhead of numpy ufuncs.
+        values = list(self.body_struct.unpack_from(packet.data, offset))
+        for index in self.position_indices:
+            values[index] = mm_to_m(values[index])
+        out.flat[:] = values
+        return out
+
+    def decode_batch(self, packets):
+        """
+            Decode many packets at once. Returns a (packets, bodies, 6) array and
+            a boolean mask of the packets that could be decoded; rows of
+            unusable packets are NaN. Without bodies (markers only) every packet
+            is usable and the frames are empty.
+        """
+        if self.body_count == 0:
+            return np.empty((len(packets), 0, EULER_BODY_VALUES)), np.ones(len(packets), dtype=bool)
+        valid = np.zeros(len(packets), dtype=bool)
+        chunks = []
+        for index, packet in enumerate(packets):
+            offset = self.body_data_offset(packet)
+            if offset is not None:
+                valid[index] = True
+                chunks.append(packet.data[offset:offset + self.body_bytes])
+        frames = np.full((len(packets), self.body_count, EULER_BODY_VALUES), np.nan)
+        if chunks:
+            frames[valid] = np.frombuffer(b"".join(chunks), dtype=EULER_BODY_DTYPE) \
+                .reshape(-1, self.body_count, EULER_BODY_VALUES)
+        return self.convert(frames), valid
+
+    def decode_markers_batch(self, packets):
+        """
+            Decode the labelled 3D markers of many packets at once. Returns a
+            (packets, markers, 3) array; occluded markers and packets without
+            usable 3D data are NaN.
+        """
+        valid = np.zeros(len(packets), dtype=bool)
+        chunks = []
+        for index, packet in enumerate(packets):
+            offset = self.marker_data_offset(packet)
+            if offset is not None:
+                valid[index] = True
+                chunks.append(packet.data[offset:offset + self.marker_bytes])
+        markers = np.full((len(packets), self.marker_count, MARKER_VALUES), np.nan)
+        if chunks and self.marker_count:
+            markers[valid] = np.frombuffer(b"".join(chunks), dtype=MARKER_DTYPE) \
+                .reshape(-1, self.marker_count, MARKER_VALUES)
+        return mm_to_m_array(markers)
 
 def new_lsl_stream_info(config, qtm_host, qtm_port):
-    info = StreamInfo(
+    return StreamInfo(
         name="qualisys",
         type="Markers",
         channel_count=1,
         channel_format=cf_int32,
         source_id="{}:{}".format(qtm_host, qtm_port),
     )
-    """
+
+# Not "qualisys", the name of the trigger stream, so recorders resolving by name tell them apart.
+LSL_DATA_STREAM_NAME = "qualisys_mocap"
+
+def new_lsl_data_stream_info(config, qtm_host, qtm_port, include_markers=False):
+    # Channels are x, y, z of each marker if included, then x, y, z and the
+    # three Euler angles of each body, both in PacketDecoder order.
+    channel_count = 6*config.body_count()
+    if include_markers:
+        channel_count = config.channel_count()
+    info = StreamInfo(
+        name=LSL_DATA_STREAM_NAME,
+        type="MoCap",
+        channel_count=channel_count,
+        nominal_srate=config.general.get("frequency") or 0,
+        channel_format=cf_float32,
+        source_id="{}:{}:mocap".format(qtm_host, qtm_port),
+    )
     channels = info.desc().append_child("channels")
     setup = info.desc().append_child("setup")
     markers = setup.append_child("markers")
     objects = setup.append_child("objects")
     cameras = setup.append_child("cameras")
-    lsl_stream_info_add_markers(config, channels, markers)
+    if include_markers:
+        lsl_stream_info_add_markers(config, channels, markers)
     lsl_stream_info_add_6dof(config, channels, objects)
     lsl_stream_info_add_cameras(config, cameras)
     info.desc().append_child("acquisition") \
         .append_child_value("manufacturer", "Qualisys") \
         .append_child_value("model", "Qualisys Track Manager")
-    """
     return info
 
 def lsl_stream_info_add_markers(config, channels, markers):
@@ -224,7 +354,7 @@ def lsl_stream_info_add_cameras(config, cameras):
     def fmt_pos(pos):
         return str(mm_to_m(pos))
     for camera in config.cameras():
-        info = cameras.append_child("cameras") \
+        info = cameras.append_child("camera") \
             .append_child_value("label", camera["id"])
         if "position" in camera:
             pos = camera["position"]
@@ -0,0 +1,70 @@
+"""
+    Growable columnar storage for 6DOF and 3D marker frames, one float array per channel per body or marker.
+"""
+
+import numpy as np
+
+CHANNELS = ['x', 'y', 'z', 'roll', 'pitch', 'yaw']
+MARKER_CHANNELS = ['x', 'y', 'z']
+DEFAULT_CAPACITY = 256
+# One value per frame: arrival time on the LSL clock, QTM camera timestamp (microseconds), QTM frame number.
+FRAME_COLUMNS = [
+    ('times', np.float64),
+    ('qtm_timestamps', np.int64),
+    ('frame_numbers', np.int64),
+]
+
+class FrameBuffer:
+    def __init__(self, body_names, capacity=DEFAULT_CAPACITY, marker_names=()):
+        self.body_names = list(body_names)
+        self.marker_names = list(marker_names)
+        self.length = 0
+        # data[body, channel] is a contiguous column, so per-channel reads are plain slices.
+        self.data = np.empty((len(self.body_names), len(CHANNELS), capacity), dtype=np.float64)
+        self.markers = np.empty((len(self.marker_names), len(MARKER_CHANNELS), capacity), dtype=np.float64)
+        for name, dtype in FRAME_COLUMNS:
+            setattr(self, name, np.empty(capacity, dtype=dtype))
+
+    def __len__(self):
+        return self.length
+
+    def capacity(self):
+        return self.data.shape[-1]
+
+    def reserve(self, capacity):
+        if capacity <= self.capacity():
+            return
+        new_capacity = self.capacity()
+        while new_capacity < capacity:
+            new_capacity *= 2
+        for name in ['data', 'markers']:
+            old = getattr(self, name)
+            new = np.empty(old.shape[:-1] + (new_capacity,), dtype=old.dtype)
+            new[..., :self.length] = old[..., :self.length]
+            setattr(self, name, new)
+        for name, dtype in FRAME_COLUMNS:
+            column = np.empty(new_capacity, dtype=dtype)
+            column[:self.length] = getattr(self, name)[:self.length]
+            setattr(self, name, column)
+
+    def extend(self, arrival_times, qtm_timestamps, frame_numbers, frames, markers=None):
+        """
+            frames has shape (frames, bodies, channels), as produced by PacketDecoder.decode_batch,
+            markers has shape (frames, markers, 3), as produced by PacketDecoder.decode_markers_batch.
+        """
+        count = len(frames)
+        self.reserve(self.length + count)
+        end = self.length + count
+        self.data[:, :, self.length:end] = np.moveaxis(frames, 0, -1)
+        self.markers[:, :, self.length:end] = np.nan if markers is None else np.moveaxis(markers, 0, -1)
+        self.times[self.length:end] = arrival_times
+        self.qtm_timestamps[self.length:end] = qtm_timestamps
+        self.frame_numbers[self.length:end] = frame_numbers
+        self.length = end
+
+    def latest(self, channel, count=1):
+        # Values of channel for every body in the most recent count frames, shape (bodies, count).
+        return self.data[:, CHANNELS.index(channel), self.length - count:self.length]
+
+    def clear(self):
+        self.length = 0
@@ -0,0 +1,86 @@
+"""
+    Detect dropped QTM frames from frame number gaps, and stream stalls from arrival times.
+"""
+
+import json
+
+import numpy as np
+
+# A pause in arrivals longer than this many frame periods (and at least STALL_MIN_SECONDS) is a stall.
+STALL_FRAME_PERIODS = 10
+STALL_MIN_SECONDS = 0.1
+
+class FrameGapTracker:
+    """
+        Frames that never arrived show up as jumps in the QTM frame number,
+        while occluded markers arrive as frames with NaN values. Gaps and
+        stalls are located by the frame number before them and the LSL clock
+        time the frame after them arrived.
+    """
+    def __init__(self, frequency=None):
+        self.last_frame_number = None
+        self.last_arrival_time = None
+        self.stall_threshold = STALL_MIN_SECONDS
+        if frequency:
+            self.stall_threshold = max(STALL_FRAME_PERIODS / frequency, STALL_MIN_SECONDS)
+        self.frame_count = 0
+        self.missing_count = 0
+        self.out_of_order_count = 0
+        self.largest_gap = 0
+        self.gaps = []
+        self.stalls = []
+
+    def add(self, frame_numbers, arrival_times):
+        frame_numbers = np.asarray(frame_numbers, dtype=np.int64)
+        arrival_times = np.asarray(arrival_times, dtype=np.float64)
+        if frame_numbers.size == 0:
+            return
+        if self.last_frame_number is not None:
+            frame_numbers = np.concatenate(([self.last_frame_number], frame_numbers))
+            arrival_times = np.concatenate(([self.last_arrival_time], arrival_times))
+            self.frame_count -= 1
+        self.frame_count += frame_numbers.size
+
+        steps = np.diff(frame_numbers)
+        self.out_of_order_count += int(np.count_nonzero(steps <= 0))
+        for index in np.flatnonzero(steps > 1).tolist():
+            missing = int(steps[index]) - 1
+            self.missing_count += missing
+            self.largest_gap = max(self.largest_gap, missing)
+            self.gaps.append({
+                "after_frame": int(frame_numbers[index]),
+                "missing_frames": missing,
+                "arrival_time": float(arrival_times[index + 1]),
+            })
+
+        pauses = np.diff(arrival_times)
+        for index in np.flatnonzero(pauses > self.stall_threshold).tolist():
+            self.stalls.append({
+                "after_frame": int(frame_numbers[index]),
+                "duration": float(pauses[index]),
+                "arrival_time": float(arrival_times[index + 1]),
+            })
+
+        self.last_frame_number = int(frame_numbers[-1])
+        self.last_arrival_time = float(arrival_times[-1])
+
+    def summary(self):
+        expected = self.frame_count + self.missing_count
+        return {
+            "frames_received": self.frame_count,
+            "frames_missing": self.missing_count,
+            "missing_ratio": self.missing_count / expected if expected else 0,
+            "gap_count": len(self.gaps),
+            "largest_gap": self.largest_gap,
+            "out_of_order": self.out_of_order_count,
+            "stall_count": len(self.stalls),
+        }
+
+    def save(self, filepath):
+        with open(filepath, 'w') as file:
+            json.dump({
+                "summary": self.summary(),
+                "stall_threshold": self.stall_threshold,
+                "gaps": self.gaps,
+                "stalls": self.stalls,
+            }, file, indent=2)
@@ -0,0 +1,85 @@
+"""
+    Run the QTM connection, decoding, triggers and recording on their own event loop in a background thread.
+"""
+
+import asyncio
+import logging
+import threading
+
+import mocap_recording
+
+LOG = logging.getLogger("qlsl")
+STATUS_INTERVAL = 1/20
+STOP_TIMEOUT = 10
+
+class IngestThread:
+    """
+        The GUI never touches the MocapRecorder directly: it submits work with
+        start_recorder/shutdown_recorder, which return concurrent futures, and
+        reads the latest RecorderStatus snapshot from self.status. Recorder
+        callbacks run on the ingest thread, so callers must pass callbacks that
+        hand over to their own thread.
+    """
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.run, name="mocap-ingest", daemon=True)
+        self.recorder = None
+        self.status = None
+        self.status_task = None
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.status_task = self.loop.create_task(self.publish_status())
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
+            LOG.debug("ingest: loop closed")
+
+    def submit(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    async def publish_status(self, interval=STATUS_INTERVAL):
+        # A fresh snapshot object is swapped in each time, so readers on other
+        # threads never see a half-updated status.
+        while True:
+            self.status = self.recorder.status() if self.recorder else None
+            await asyncio.sleep(interval)
+
+    async def _start_recorder(self, **kwargs):
+        self.recorder = None
+        self.recorder = await mocap_recording.init(**kwargs)
+        return self.recorder
+
+    def start_recorder(self, **kwargs):
+        """
+            Connect to QTM with mocap_recording.init(**kwargs) on the ingest thread.
+        """
+        return self.submit(self._start_recorder(**kwargs))
+
+    async def _shutdown_recorder(self):
+        if self.recorder:
+            await self.recorder.shutdown()
+
+    def shutdown_recorder(self):
+        return self.submit(self._shutdown_recorder())
+
+    async def _stop(self):
+        await self._shutdown_recorder()
+        tasks = [task for task in asyncio.all_tasks(self.loop) if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stop(self, timeout=STOP_TIMEOUT):
+        if not self.thread.is_alive():
+            return
+        try:
+            self.submit(self._stop()).result(timeout)
+        except Exception as ex:
+            LOG.error("ingest: stop exception: " + repr(ex))
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout)
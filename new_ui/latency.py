@@ -0,0 +1,115 @@
+"""
+    Latency histograms from QTM frame to LSL trigger push, with a per-trial summary sidecar.
+"""
+
+import json
+import threading
+
+import numpy as np
+
+# 20 log-spaced bins per decade from 1 us to 10 s.
+BIN_EDGES = np.logspace(-6, 1, 141)
+PERCENTILES = [50, 95, 99]
+
+class LatencyHistogram:
+    def __init__(self):
+        # counts[i] holds values in (BIN_EDGES[i-1], BIN_EDGES[i]], the last bin everything above 10 s.
+        self.counts = np.zeros(len(BIN_EDGES) + 1, dtype=np.int64)
+        self.count = 0
+        self.max = 0.0
+
+    def add(self, latencies):
+        latencies = np.asarray(latencies, dtype=np.float64).ravel()
+        latencies = latencies[~np.isnan(latencies)]
+        if latencies.size == 0:
+            return
+        self.counts += np.bincount(np.searchsorted(BIN_EDGES, latencies), minlength=len(self.counts))
+        self.count += latencies.size
+        self.max = max(self.max, float(latencies.max()))
+
+    def percentile(self, percentile):
+        """
+            Upper edge of the bin holding the percentile, i.e. accurate to
+            about 12%, and never more than the largest value seen.
+        """
+        if self.count == 0:
+            return None
+        rank = percentile / 100 * self.count
+        index = int(np.searchsorted(np.cumsum(self.counts), rank))
+        edge = BIN_EDGES[min(index, len(BIN_EDGES) - 1)]
+        return min(float(edge), self.max)
+
+    def summary(self):
+        summary = {"count": self.count}
+        for percentile in PERCENTILES:
+            summary["p{}".format(percentile)] = self.percentile(percentile)
+        summary["max"] = self.max if self.count else None
+        return summary
+
+class LatencyMonitor:
+    """
+        Per-frame stages, all in seconds on the LSL clock except the QTM timestamp:
+            qtm_to_arrival      packet arrival minus QTM frame time, relative to the
+                                fastest frame seen since QTM and LSL clocks are not related
+            arrival_to_decoded  queueing plus decoding, until the frame is in the FrameBuffer
+            arrival_to_frame_push
+                                until the frame was pushed on the MoCap LSL stream
+            arrival_to_trigger_push
+                                until the angle trigger caused by the frame was pushed
+            trigger_deadline_to_push
+                                periodic and end triggers, from the time they are
+                                stamped with (their deadline) until they were pushed
+
+        Triggers are pushed from the periodic trigger thread too, so updates are locked.
+    """
+    STAGES = [
+        "qtm_to_arrival",
+        "arrival_to_decoded",
+        "arrival_to_frame_push",
+        "arrival_to_trigger_push",
+        "trigger_deadline_to_push",
+    ]
+
+    def __init__(self):
+        self.histograms = {stage: LatencyHistogram() for stage in self.STAGES}
+        self.min_transport_offset = None
+        self.lock = threading.Lock()
+
+    def add_frames(self, qtm_timestamps, arrival_times, decoded_time):
+        arrival_times = np.asarray(arrival_times, dtype=np.float64)
+        transport_offsets = arrival_times - np.asarray(qtm_timestamps, dtype=np.float64) / 1e6
+        batch_min = float(transport_offsets.min())
+        with self.lock:
+            if self.min_transport_offset is None or batch_min < self.min_transport_offset:
+                self.min_transport_offset = batch_min
+            self.histograms["qtm_to_arrival"].add(transport_offsets - self.min_transport_offset)
+            self.histograms["arrival_to_decoded"].add(decoded_time - arrival_times)
+
+    def add_frame_push(self, arrival_times, push_time):
+        self.add_delay("arrival_to_frame_push", arrival_times, push_time)
+
+    def add_trigger_push(self, arrival_time, push_time):
+        self.add_delay("arrival_to_trigger_push", arrival_time, push_time)
+
+    def add_deadline_push(self, deadline, push_time):
+        self.add_delay("trigger_deadline_to_push", deadline, push_time)
+
+    def add_delay(self, stage, start_times, end_time):
+        # One start time or an array of them, e.g. for the frames of a chunk.
+        with self.lock:
+            self.histograms[stage].add(end_time - np.asarray(start_times, dtype=np.float64))
+
+    def summary(self):
+        with self.lock:
+            return {stage: histogram.summary() for stage, histogram in self.histograms.items()}
+
+    def save(self, filepath):
+        with open(filepath, 'w') as file:
+            json.dump({
+                "unit": "seconds",
+                "bin_edges": BIN_EDGES.tolist(),
+                "stages": {
+                    stage: dict(histogram.summary(), counts=histogram.counts.tolist())
+                    for stage, histogram in self.histograms.items()
+                },
+            }, file, indent=2)
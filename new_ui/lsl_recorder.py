@@ -0,0 +1,258 @@
+"""
+    Record other LSL streams, e.g. EEG and triggers, into the same trial output as the mocap data.
+"""
+
+import csv
+import logging
+import re
+import threading
+
+import numpy as np
+from pylsl import (
+    ContinuousResolver,
+    LostError,
+    StreamInlet,
+    cf_double64,
+    cf_float32,
+    cf_int16,
+    cf_int32,
+    cf_int64,
+    cf_int8,
+    cf_string,
+    local_clock,
+    proc_clocksync,
+    proc_dejitter,
+)
+
+from trial_format import (
+    TRIAL_EXTENSION,
+    TrialFile,
+    export_csv,
+    format_timestamps,
+    new_stream_header,
+    stream_csv_header,
+    stream_record_dtype,
+    wall_times,
+)
+
+LOG = logging.getLogger("qlsl")
+
+# Seconds to wait for the streams after the recording started, and for a found stream to answer.
+RESOLVE_TIMEOUT = 2.0
+PULL_INTERVAL = 0.02
+MAX_CHUNK_SAMPLES = 4096
+# Seconds of data each inlet buffers while the recorder is busy.
+INLET_BUFFER = 60
+
+VALUE_TYPES = {
+    cf_float32: '<f4',
+    cf_double64: '<f8',
+    cf_int8: 'i1',
+    cf_int16: '<i2',
+    cf_int32: '<i4',
+    cf_int64: '<i8',
+}
+
+def stream_filepath(filepath, stream_name):
+    return "{}_lsl_{}".format(filepath, re.sub(r"[^\w-]+", "_", stream_name))
+
+def stream_description(info):
+    # Only the info of an inlet carries the desc() of the stream, with the channel labels.
+    labels = []
+    channel = info.desc().child("channels").child("channel")
+    while not channel.empty():
+        labels.append(channel.child_value("label"))
+        channel = channel.next_sibling()
+    return {
+        "name": info.name(),
+        "type": info.type(),
+        "source_id": info.source_id(),
+        "hostname": info.hostname(),
+        "channel_count": info.channel_count(),
+        "nominal_srate": info.nominal_srate(),
+        "channel_format": info.channel_format(),
+        "channels": labels,
+    }
+
+def open_inlet(info):
+    # Timestamps are converted to this computer's LSL clock, the clock of the
+    # mocap trial, and smoothed for regularly sampled streams. The stream is
+    # opened right away, so samples are buffered from now on.
+    processing_flags = proc_clocksync
+    if info.nominal_srate() > 0:
+        processing_flags |= proc_dejitter
+    inlet = StreamInlet(info, max_buflen=INLET_BUFFER, processing_flags=processing_flags)
+    inlet.open_stream(RESOLVE_TIMEOUT)
+    return inlet
+
+class StreamWriter:
+    """
+        Pulls chunks of a numeric stream straight into a preallocated array
+        and appends them to a .trial file.
+    """
+    def __init__(self, info, filepath, clock_anchor):
+        self.inlet = open_inlet(info)
+        self.stream = stream_description(self.inlet.info(RESOLVE_TIMEOUT))
+        self.filepath = filepath
+        self.buffer = np.empty(
+            (MAX_CHUNK_SAMPLES, self.stream["channel_count"]),
+            dtype=VALUE_TYPES[self.stream["channel_format"]],
+        )
+        dtype = stream_record_dtype(self.buffer.dtype, self.stream["channel_count"])
+        header = new_stream_header(self.stream, clock_anchor)
+        self.trial_file = TrialFile(filepath + TRIAL_EXTENSION, header, dtype)
+        self.sample_count = 0
+        self.lost = False
+
+    def open(self):
+        self.trial_file.open()
+
+    def pull(self):
+        _, timestamps = self.inlet.pull_chunk(timeout=0.0, max_samples=MAX_CHUNK_SAMPLES, dest_obj=self.buffer)
+        if timestamps:
+            self.trial_file.append(time=timestamps, data=self.buffer[:len(timestamps)])
+            self.sample_count += len(timestamps)
+        return len(timestamps)
+
+    def close(self):
+        self.inlet.close_stream()
+        self.trial_file.close()
+
+    def export(self):
+        return export_csv(self.trial_file.filepath, self.filepath)
+
+class StringStreamWriter:
+    """
+        String streams, e.g. event markers, have no fixed record size. They
+        are rare, so they are written to the CSV file as they arrive.
+    """
+    def __init__(self, info, filepath, clock_anchor):
+        self.inlet = open_inlet(info)
+        self.stream = stream_description(self.inlet.info(RESOLVE_TIMEOUT))
+        self.filepath = filepath
+        self.header = new_stream_header(self.stream, clock_anchor)
+        self.file = None
+        self.csv_writer = None
+        self.sample_count = 0
+        self.lost = False
+
+    def open(self):
+        self.file = open(f"{self.filepath}.csv", 'w', newline='')
+        self.csv_writer = csv.writer(self.file)
+        self.csv_writer.writerow(stream_csv_header(self.stream))
+
+    def pull(self):
+        samples, timestamps = self.inlet.pull_chunk(timeout=0.0, max_samples=MAX_CHUNK_SAMPLES)
+        if timestamps:
+            formatted = format_timestamps(wall_times(self.header, np.array(timestamps))).tolist()
+            self.csv_writer.writerows([timestamp] + sample for timestamp, sample in zip(formatted, samples))
+            self.sample_count += len(timestamps)
+        return len(timestamps)
+
+    def close(self):
+        self.inlet.close_stream()
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def export(self):
+        return [f"{self.filepath}.csv"]
+
+class LslRecorder:
+    """
+        Resolves the LSL streams with the given names and records them until
+        stop(), all inlets pulled in chunks from one background thread.
+        Timestamps share the LSL clock and the clock_anchor of the mocap trial,
+        so the exported CSV files line up with the mocap CSV files.
+    """
+    def __init__(self, filepath, stream_names, clock_anchor):
+        self.filepath = filepath
+        self.stream_names = list(stream_names)
+        self.clock_anchor = clock_anchor
+        self.writers = []
+        self.missing_streams = []
+        self.stop_event = threading.Event()
+        self.closed_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="lsl-recorder", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+            Returns once the last samples are written and the files closed.
+        """
+        self.stop_event.set()
+        if self.thread:
+            self.closed_event.wait()
+            self.thread = None
+
+    def resolve(self, resolver, pending, deadline):
+        """
+            Open a writer for every pending stream the resolver has found so
+            far. Streams still missing at the deadline are given up on.
+        """
+        for info in resolver.results():
+            stream_name = info.name()
+            if stream_name not in pending:
+                continue
+            pending.remove(stream_name)
+            writer_class = StringStreamWriter if info.channel_format() == cf_string else StreamWriter
+            writer = writer_class(info, stream_filepath(self.filepath, stream_name), self.clock_anchor)
+            writer.open()
+            self.writers.append(writer)
+            LOG.info("Recording LSL stream '{}' ({} channels, {} Hz)".format(
+                stream_name, info.channel_count(), info.nominal_srate(),
+            ))
+        if local_clock() > deadline:
+            for stream_name in sorted(pending):
+                LOG.warning("LSL stream '{}' not found, it is not recorded".format(stream_name))
+                self.missing_streams.append(stream_name)
+            pending.clear()
+
+    def run(self):
+        try:
+            # Streams are recorded as soon as they are found, without waiting for the others.
+            resolver = ContinuousResolver()
+            pending = set(self.stream_names)
+            deadline = local_clock() + RESOLVE_TIMEOUT
+            while True:
+                stopping = self.stop_event.is_set()
+                if pending:
+                    self.resolve(resolver, pending, deadline)
+                pulled = 0
+                for writer in self.writers:
+                    if writer.lost:
+                        continue
+                    try:
+                        pulled += writer.pull()
+                    except LostError:
+                        # What was recorded so far is still exported.
+                        LOG.error("LSL stream '{}' was lost".format(writer.stream["name"]))
+                        writer.lost = True
+                # One last pull after stop() so the samples up to now are kept.
+                if stopping:
+                    break
+                if not pulled:
+                    self.stop_event.wait(PULL_INTERVAL)
+        except Exception as ex:
+            LOG.error("lsl recorder: exception: " + repr(ex))
+        finally:
+            for writer in self.writers:
+                writer.close()
+            self.closed_event.set()
+            # Destroying an inlet blocks for about half a second in liblsl, so
+            # it is left to this thread instead of holding up stop().
+            for writer in self.writers:
+                writer.inlet = None
+
+    def finalize(self):
+        """
+            Export every recorded stream to CSV, call after stop(). Returns the paths written.
+        """
+        csv_filepaths = []
+        for writer in self.writers:
+            csv_filepaths += writer.export()
+            LOG.info("Recorded {} samples of LSL stream '{}'".format(writer.sample_count, writer.stream["name"]))
+        return csv_filepaths
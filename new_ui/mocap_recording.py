@@ -3,27 +3,47 @@
 """
 
 import asyncio
+from collections import namedtuple
+import copy
 from enum import Enum
 import logging
 import time
-import threading
-import csv
-import math
 
-from pylsl import StreamInfo, StreamOutlet
+import numpy as np
+from pylsl import StreamInfo, StreamOutlet, local_clock
 import qtm
 from qtm import QRTEvent
 
 from config import (
     Config,
+    PacketDecoder,
+    new_lsl_data_stream_info,
     new_lsl_stream_info,
     parse_qtm_parameters,
-    qtm_packet_to_lsl_sample,
+)
+from clock_sync import QtmClock, clock_sync_filepath
+from frame_buffer import FrameBuffer
+from frame_gaps import FrameGapTracker
+from latency import LatencyMonitor
+from lsl_recorder import LslRecorder
+from packet_queue import (
+    DEFAULT_MAXSIZE,
+    OverflowPolicy,
+    PacketQueue,
+    ReceiverStats,
+)
+from trial_writer import TrialWriter
+from triggers import (
+    ANGLE_TRIGGER_STEP,
+    PERIODIC_TRIGGER_PERIOD,
+    AngleTriggerDetector,
+    PeriodicTriggers,
 )
 
 LOG = logging.getLogger("qlsl")
 QTM_DEFAULT_PORT = 22223
 QTM_DEFAULT_VERSION = "1.19"
+FRAME_CHUNK_SIZE = 256
 
 class State(Enum):
     INITIAL = 1
@@ -31,23 +51,48 @@ class State(Enum):
     STREAMING = 3
     STOPPED = 4
 
+# Point-in-time copy of the recorder state that is safe to read from another thread.
+RecorderStatus = namedtuple("RecorderStatus", "state packet_count elapsed_time receiver_stats latency frame_gaps")
+
 class MocapRecorder:
-    def __init__(self, host, port, on_state_changed, on_error, starting_yaw):
+    def __init__(self, host, port, on_state_changed, on_error, starting_yaw, filepath=None,
+            queue_size=DEFAULT_MAXSIZE, overflow_policy=OverflowPolicy.DROP_OLDEST, stream_markers=False,
+            trigger_period=PERIODIC_TRIGGER_PERIOD, angle_step=ANGLE_TRIGGER_STEP, lsl_streams=()):
         self.host = host
         self.port = port
         self._on_state_changed = on_state_changed
         self._on_error = on_error
         self.starting_yaw = starting_yaw
-        self.samples = {}
-        self.timestamps = {}
-        self.periodic_thread = None
+        self.filepath = filepath
+        # Each QTM start/stop within a trial is a segment with its own files, see segment_filepath.
+        self.segment_count = 0
+        self.segment_filepath = None
+        self.queue_size = queue_size
+        self.overflow_policy = overflow_policy
+        self.stream_markers = stream_markers
+        self.trigger_period = trigger_period
+        self.angle_step = angle_step
+        # Names of other LSL streams, e.g. EEG, recorded next to the mocap data.
+        self.lsl_streams = list(lsl_streams)
+        self.receiver_stats = ReceiverStats()
+        self.latency = LatencyMonitor()
+        self.frame_gaps = FrameGapTracker()
+        self.qtm_clock = QtmClock()
+        self.has_overflowed = False
+        self.trial_writer = None
+        self.lsl_recorder = None
+        self.decoder = None
+        self.frames = None
+        self.skate_body_indices = []
+        self.periodic_triggers = None
+        self.angle_triggers = None
+        self.last_frame_time = None
 
         self.state = State.INITIAL
         self.conn = None
         self.packet_count = 0
         self.start_time = 0
         self.stop_time = 0
-        self.last_yaw = None
         self.start_angle_to_trigger = {-90: 100, -45: 200, 0: 300, 45: 400, 90: 500}
         self.reset_stream_context()
     
@@ -59,7 +104,13 @@ class MocapRecorder:
         self.lsl_outlet = None
         self.lsl_periodic_info = None
         self.lsl_periodic_outlet = None
-        self.samples = {}
+        self.lsl_data_info = None
+        self.lsl_data_outlet = None
+        self.trial_writer = None
+        self.lsl_recorder = None
+        self.decoder = None
+        self.frames = None
+        self.skate_body_indices = []
     
     def set_state(self, state):
         prev_state = self.state
@@ -86,6 +137,16 @@ class MocapRecorder:
             return self.stop_time - self.start_time
         return 0
     
+    def status(self):
+        return RecorderStatus(
+            self.state,
+            self.packet_count,
+            self.elapsed_time(),
+            copy.copy(self.receiver_stats),
+            self.latency.summary(),
+            self.frame_gaps.summary(),
+        )
+
     def on_state_changed(self, new_state):
         if self._on_state_changed:
             self._on_state_changed(new_state)
@@ -126,22 +187,26 @@ class MocapRecorder:
     def open_lsl_stream_outlet(self):
         self.lsl_info = new_lsl_stream_info(self.config, self.host, self.port)
         self.lsl_outlet = StreamOutlet(info=self.lsl_info, max_buffered=180)
+        self.lsl_data_info = new_lsl_data_stream_info(
+            self.config, self.host, self.port, include_markers=self.stream_markers,
+        )
+        if self.lsl_data_info.channel_count() == 0:
+            # Markers only and not streamed: pylsl cannot push to an outlet without channels.
+            LOG.info("No 6DOF bodies, the MoCap LSL stream is not published")
+            return
+        self.lsl_data_outlet = StreamOutlet(info=self.lsl_data_info, max_buffered=180)
     
     def err_disconnect(self, err_msg):
         asyncio.ensure_future(self.shutdown(err_msg))
 
-    async def shutdown(self, filepath=None, err_msg=None):
+    async def shutdown(self, err_msg=None):
         try:
             if self.state == State.STREAMING:
-                self.lsl_outlet.push_sample([self.start_angle_to_trigger[self.starting_yaw] + 1])
-                await self.stop_stream(filepath)
+                await self.stop_stream(end_trigger=True)
 
             if self.conn and self.conn.has_transport():
                 self.conn.disconnect()
 
-            if self.periodic_thread:
-                self.periodic_thread.join()
-
             LOG.debug("link: shutdown enter")
             self.conn = None
         finally:
@@ -150,22 +215,59 @@ class MocapRecorder:
                 self.on_error(err_msg)
             LOG.debug("link: shutdown exit")
 
-    async def stop_stream(self, filepath=None):
+    async def stop_stream(self, end_trigger=False):
         if self.conn and self.conn.has_transport():
             try:
                 await self.conn.stream_frames_stop()
             except qtm.QRTCommandException as ex:
                 LOG.error("QTM: stream_frames_stop exception: " + str(ex))
-        if self.receiver_queue:
-            self.receiver_queue.put_nowait(None)
-            await self.receiver_task
-        if filepath:
-            self.save_data(filepath)
-        self.reset_stream_context()
-        if self.state == State.STREAMING:
-            LOG.info("Stream stopped")
-            self.stop_time = time.time()
-            self.set_state(State.WAITING)
+        self.stop_periodic_triggers()
+        try:
+            if self.lsl_recorder:
+                self.lsl_recorder.stop()
+            if self.receiver_queue is not None:
+                self.receiver_queue.close()
+                try:
+                    await self.receiver_task
+                except asyncio.CancelledError:
+                    raise
+                except Exception as ex:
+                    # Already reported by stream_receiver, the frames it processed are still saved below.
+                    LOG.error("link: stop_stream: stream_receiver failed: " + repr(ex))
+                self.receiver_stats.update_queue(self.receiver_queue)
+            if end_trigger and self.lsl_outlet:
+                # After the queued frames, so it is the last trigger and carries the time of the last frame.
+                self.push_trigger(self.start_angle_to_trigger[self.starting_yaw] + 1, self.last_frame_time or 0.0)
+        finally:
+            # Whatever went wrong above, the trial is finalized with the frames received so far.
+            self.finalize_trial()
+            self.reset_stream_context()
+            if self.state == State.STREAMING:
+                LOG.info("Stream stopped")
+                self.stop_time = time.time()
+                self.set_state(State.WAITING)
+
+    def next_segment_filepath(self):
+        # The first segment keeps the trial's own name, so a trial recorded in one go is unchanged.
+        self.segment_count += 1
+        if self.segment_count == 1:
+            return self.filepath
+        return f"{self.filepath}_segment{self.segment_count}"
+
+    def finalize_trial(self):
+        if self.frames is not None:
+            try:
+                self.flush_frames()
+            except Exception as ex:
+                LOG.error("link: flush_frames exception: " + repr(ex))
+        if self.trial_writer:
+            # Saved first, the CSV export corrects timestamps with it.
+            self.qtm_clock.save(clock_sync_filepath(self.segment_filepath))
+            self.trial_writer.finalize()
+            self.latency.save(f"{self.segment_filepath}_latency.json")
+            self.frame_gaps.save(f"{self.segment_filepath}_gaps.json")
+        if self.lsl_recorder:
+            self.lsl_recorder.finalize()
     
     async def start_stream(self):
         try:
@@ -180,22 +282,50 @@ class MocapRecorder:
                 self.err_disconnect("No 3D or 6DOF data available from QTM")
                 return
             self.config = config
-            self.receiver_queue = asyncio.Queue()
+            self.decoder = PacketDecoder(config)
+            body_names = self.decoder.body_names
+            self.frames = FrameBuffer(body_names, capacity=FRAME_CHUNK_SIZE, marker_names=self.decoder.marker_names)
+            self.skate_body_indices = [
+                index for index, body_name in enumerate(body_names) if "skate" in body_name
+            ]
+            if self.filepath:
+                self.segment_filepath = self.next_segment_filepath()
+                clock_anchor = (local_clock(), time.time())
+                self.trial_writer = TrialWriter(self.segment_filepath, config, self.starting_yaw, clock_anchor)
+                self.trial_writer.open()
+                if self.lsl_streams:
+                    # Same anchor, so the exported streams share the mocap timestamps.
+                    self.lsl_recorder = LslRecorder(self.segment_filepath, self.lsl_streams, clock_anchor)
+                    self.lsl_recorder.start()
+            self.receiver_stats = ReceiverStats()
+            self.latency = LatencyMonitor()
+            self.frame_gaps = FrameGapTracker(config.general.get("frequency"))
+            self.qtm_clock = QtmClock()
+            self.last_frame_time = None
+            self.angle_triggers = AngleTriggerDetector(
+                len(self.skate_body_indices), self.angle_step, self.starting_yaw,
+            )
+            self.has_overflowed = False
+            self.packet_count = 0
+            # Started by the first frame, see process_batch, so
+            # it must exist before the receiver can see any packet.
+            self.periodic_triggers = PeriodicTriggers(
+                self.push_trigger,
+                first_value=self.start_angle_to_trigger[self.starting_yaw],
+                period=self.trigger_period,
+            )
+            self.receiver_queue = PacketQueue(self.queue_size, self.overflow_policy, self.on_queue_overflow)
             self.receiver_task = asyncio.ensure_future(self.stream_receiver())
             self.open_lsl_stream_outlet()
             await self.conn.stream_frames(
                 components=["3d", "6deuler"],
-                on_packet=self.receiver_queue.put_nowait,
+                on_packet=self.on_packet,
             )
             LOG.info("Stream started with {} marker(s) and {} rigid bod(y/ies)".format(
                 config.marker_count(), config.body_count(),
             ))
-            self.packet_count = 0
             self.start_time = time.time()
             self.set_state(State.STREAMING)
-            self.periodic_thread = threading.Thread(target=self.push_periodic_triggers)
-            self.periodic_thread.daemon = True
-            self.periodic_thread.start()
         except asyncio.CancelledError:
             raise
         except qtm.QRTCommandException as ex:
@@ -210,35 +340,13 @@ class MocapRecorder:
         try:
             LOG.debug("link: stream_receiver enter")
             while True:
-                packet = await self.receiver_queue.get()
-                if packet is None:
+                batch = await self.receiver_queue.get_batch()
+                if batch is None:
                     break
-                all_bodies_sample = qtm_packet_to_lsl_sample(self.config, packet)
-
-                length = 0
-                for test in all_bodies_sample.values():
-                    length += len(test)
-
-                if length != self.config.channel_count():
-                    msg = ("Stream canceled: "
-                        "sample length {} != channel count {}") \
-                        .format(len(all_bodies_sample), self.config.channel_count())
-                    LOG.error(msg)
-                    self.err_disconnect(("Stream canceled: "
-                        "QTM stream data inconsistent with LSL metadata"))
-                else:
-                    self.packet_count += 1
-                    for body_name, data in all_bodies_sample.items():
-                        try:
-                            self.samples[body_name].append(data)
-                        except:
-                            self.samples[body_name] = []
-                            self.timestamps[body_name] = []
-                        
-                        self.samples[body_name].append(data)
-                        self.timestamps[body_name].append(self.get_formatted_timestamp())
-                        if "skate" in body_name:
-                            self.push_angle_triggers(data)
+                start = time.perf_counter()
+                self.process_batch(batch)
+                self.receiver_stats.update_queue(self.receiver_queue)
+                self.receiver_stats.add_batch(len(batch), time.perf_counter() - start)
         except asyncio.CancelledError:
             raise
         except Exception as ex:
@@ -248,54 +356,98 @@ class MocapRecorder:
         finally:
             LOG.debug("link: stream_receiver exit")
 
-    def get_formatted_timestamp(self):
-        timestamp = time.time()
-        date_and_time = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(timestamp))
-        return date_and_time + str(timestamp - int(timestamp))[1:7]
+    def process_batch(self, batch):
+        arrival_times, packets = zip(*batch)
+        frames, valid = self.decoder.decode_batch(packets)
+        markers = self.decoder.decode_markers_batch(packets)
+        if not valid.all():
+            msg = ("Stream canceled: "
+                "{} packet(s) have no 6DOF data for the {} configured bodies") \
+                .format(len(batch) - int(valid.sum()), self.decoder.body_count)
+            LOG.error(msg)
+            self.err_disconnect(("Stream canceled: "
+                "QTM stream data inconsistent with LSL metadata"))
+            arrival_times = np.asarray(arrival_times)[valid]
+            packets = [packet for packet, is_valid in zip(packets, valid) if is_valid]
+            frames = frames[valid]
+            markers = markers[valid]
+        if len(packets) == 0:
+            return
+        self.packet_count += len(packets)
+        qtm_timestamps = [packet.timestamp for packet in packets]
+        frame_numbers = [packet.framenumber for packet in packets]
+        self.frames.extend(arrival_times, qtm_timestamps, frame_numbers, frames, markers)
+        self.frame_gaps.add(frame_numbers, arrival_times)
+        self.latency.add_frames(qtm_timestamps, arrival_times, local_clock())
+        self.qtm_clock.update(qtm_timestamps, arrival_times)
+        lsl_times = self.qtm_clock.to_lsl(qtm_timestamps)
+        self.last_frame_time = float(lsl_times[-1])
+        if self.periodic_triggers and not self.periodic_triggers.is_started():
+            # The start trigger and the periodic grid after it are aligned to the capture time of the first frame.
+            self.periodic_triggers.start(start_time=float(lsl_times[0]))
+        self.push_frames(frames, markers, arrival_times, lsl_times, frame_numbers)
+        self.push_angle_triggers(arrival_times, lsl_times)
+        if len(self.frames) >= FRAME_CHUNK_SIZE:
+            self.flush_frames()
 
-    def save_data(self, filepath):
-        header = ['timestamp', 'x', 'y', 'z', 'roll', 'pitch', 'yaw']
-        for body_name in self.timestamps.keys():
-            with open(f"{filepath}_{body_name}.csv", 'w', newline='') as file:
-                csv_writer = csv.writer(file)
-                csv_writer.writerow(header)
-                for timestamp, sample in zip(self.timestamps[body_name], self.samples[body_name]):
-                    # Zero yaw is defined along the x-axis, but in the room, we want it to be along the y-axis because of how
-                    # the experiment is set up, so we add 90 degrees to all yaw measurements.
-                    #if "skate" in body_name:
-                    #    sample[-1] += 90
-                    #    if sample[-1] >= 360:
-                    #        sample[-1] -= 360
-                    csv_writer.writerow([timestamp] + sample)
-        
-            nan_percentage = sum(math.isnan(sample[0]) for sample in self.samples[body_name]) / len(self.samples[body_name])
-            if nan_percentage > 0.33:
-                LOG.warn(f"More than 30% of the motion capture data for {body_name} is lost. Consider rerecording this trial!")
+    def flush_frames(self):
+        if self.trial_writer:
+            self.trial_writer.write(self.frames)
+        self.frames.clear()
 
-    
-    def push_periodic_triggers(self):
-        has_pushed_first_trigger = False
-        while self.conn and self.lsl_outlet:
-            if not has_pushed_first_trigger:
-                self.lsl_outlet.push_sample([self.start_angle_to_trigger[self.starting_yaw]])
-                has_pushed_first_trigger = True
-                LOG.debug("pushed first periodic sample")
-            else:
-                LOG.debug("pushed periodic sample")
-                self.lsl_outlet.push_sample([1])
-            time.sleep(1)
+    def push_frames(self, frames, markers, arrival_times, lsl_times, frame_numbers):
+        if self.lsl_data_outlet is None:
+            return
+        samples = frames.reshape(len(frames), -1)
+        if self.stream_markers:
+            samples = np.concatenate((markers.reshape(len(markers), -1), samples), axis=1)
+        samples = samples.astype(np.float32)
+        lsl_times = lsl_times.tolist()
+        # push_chunk stamps the last sample and derives the others from the
+        # nominal rate, so chunks are split wherever frames are missing.
+        if self.lsl_data_info.nominal_srate() > 0:
+            ends = np.flatnonzero(np.diff(frame_numbers) != 1) + 1
+            ends = ends.tolist() + [len(samples)]
+        else:
+            ends = range(1, len(samples) + 1)
+        start = 0
+        for end in ends:
+            self.lsl_data_outlet.push_chunk(samples[start:end], lsl_times[end - 1])
+            start = end
+        self.latency.add_frame_push(arrival_times, local_clock())
+
+    def on_packet(self, packet):
+        self.receiver_queue.put_nowait((local_clock(), packet))
+
+    def on_queue_overflow(self):
+        if self.has_overflowed:
+            return
+        self.has_overflowed = True
+        if self.overflow_policy != OverflowPolicy.STOP:
+            LOG.warning("Packet queue full ({} packets), the stream receiver is falling behind, dropping packets ({})"
+                .format(self.queue_size, self.overflow_policy.name.lower()))
+            return
+        LOG.error("Packet queue full ({} packets), the stream receiver is falling behind".format(self.queue_size))
+        self.err_disconnect("Stream canceled: motion capture data arrived faster than it could be processed")
+
+    def stop_periodic_triggers(self):
+        if self.periodic_triggers:
+            self.periodic_triggers.stop()
+            self.periodic_triggers = None
+
+    def push_trigger(self, value, timestamp=0.0):
+        self.lsl_outlet.push_sample([value], timestamp)
+        if timestamp:
+            self.latency.add_deadline_push(timestamp, local_clock())
+
+    def push_angle_triggers(self, arrival_times, lsl_times):
+        yaws = self.frames.latest('yaw', len(arrival_times))[self.skate_body_indices].T
+        frame_indices, angles, timestamps = self.angle_triggers.detect(yaws, lsl_times)
+        for frame_index, yaw, timestamp in zip(frame_indices.tolist(), angles.tolist(), timestamps.tolist()):
+            LOG.debug(f"pushed angle {yaw}")
+            self.lsl_outlet.push_sample([yaw], timestamp)
+            self.latency.add_trigger_push(arrival_times[frame_index], local_clock())
 
-    def push_angle_triggers(self, sample):
-        if len(sample) == 6:
-            try:
-                yaw = round(sample[-1]) - self.starting_yaw
-                if yaw % 10 == 0 and self.last_yaw != yaw:
-                    LOG.debug(f"pushed angle {yaw}")
-                    self.lsl_outlet.push_sample([yaw])
-                    self.last_yaw = yaw
-            except:
-                pass
-            
 
 class LinkError(Exception):
     pass
@@ -306,10 +458,21 @@ async def init(
     qtm_version=QTM_DEFAULT_VERSION,
     on_state_changed=None,
     on_error=None,
-    starting_yaw=None
+    starting_yaw=None,
+    filepath=None,
+    queue_size=DEFAULT_MAXSIZE,
+    overflow_policy=OverflowPolicy.DROP_OLDEST,
+    stream_markers=False,
+    trigger_period=PERIODIC_TRIGGER_PERIOD,
+    angle_step=ANGLE_TRIGGER_STEP,
+    lsl_streams=(),
 ):
     LOG.debug("link: init enter")
-    link = MocapRecorder(qtm_host, qtm_port, on_state_changed, on_error, starting_yaw)
+    link = MocapRecorder(
+        qtm_host, qtm_port, on_state_changed, on_error, starting_yaw, filepath,
+        queue_size, overflow_policy, stream_markers, trigger_period, angle_step,
+        lsl_streams,
+    )
     try:
         link.conn = await qtm.connect(
             host=qtm_host,
@@ -1,8 +1,6 @@
 import tkinter as tk
 from tkinter import filedialog
 from tkinter import messagebox
-import cv2
-from PIL import Image, ImageTk
 from enum import Enum
 import os
 from datetime import datetime
@@ -11,8 +9,16 @@ import logging
 import time
 
 import mocap_recording as mocap_recording
+from ingest_thread import IngestThread
+from preview import PreviewRenderer
+from trial_camera import TrialCamera
 
 LOG = logging.getLogger("qlsl")
+# cv2.VideoCapture indices of the cameras filming the skating area, e.g. [0, 1] for two.
+# A camera that cannot be opened shows as not available and its trials have no video.
+CAMERA_SOURCES = [0]
+# One of trial_camera.VIDEO_CODECS, see benchmarks/video_codecs.py for their cost.
+VIDEO_CODEC = "mp4v"
 
 class PickingPhase(Enum):
     BABY_POSITION = 0
@@ -35,9 +41,12 @@ class App(tk.Frame):
         self.baby_and_mother_idxs = [None, None]
         self.parent_directory = 'C:\\Users\\QTM\\Desktop\\motion_capture_data'
         self.recording = False
-        self.cap = None
-        self.video_recorder = None
+        self.cameras = []
+        self.previews = []
         self.mocap_recorder = None
+        # QTM ingest runs on its own thread so GUI and camera work cannot delay packets or triggers.
+        self.ingest = IngestThread()
+        self.ingest.start()
         self.create_layout()
 
     def main_loop(self):
@@ -45,6 +54,9 @@ class App(tk.Frame):
         self.async_loop.run_forever()
 
     async def stop_main_loop(self):
+        self.ingest.stop()
+        for camera in self.cameras:
+            camera.stop()
         self.async_loop.stop()
         self.master.destroy()
         LOG.debug("gui: stop_main_loop")
@@ -60,22 +72,30 @@ class App(tk.Frame):
             LOG.debug("gui: updater enter")
             while True:
                 self.update()
-                if self.recording and self.mocap_recorder:
-                    self.mocap_elapsed_time.set(f"Elapsed time: {self.get_formatted_time()}")
-                    self.mocap_packet_number.set(f"Packets received: {self.get_formatted_packet_count()}")
+                status = self.ingest.status
+                if self.recording and self.mocap_recorder and status:
+                    self.mocap_elapsed_time.set(f"Elapsed time: {self.get_formatted_time(status)}")
+                    self.mocap_packet_number.set(f"Packets received: {self.get_formatted_packet_count(status)}")
+                    self.mocap_receiver_status.set(self.get_formatted_receiver_status(status))
+                    self.mocap_latency.set(self.get_formatted_latency(status))
+                    self.mocap_frame_gaps.set(self.get_formatted_frame_gaps(status))
                 else:
                     self.mocap_elapsed_time.set("")
                     self.mocap_packet_number.set("")
+                    self.mocap_receiver_status.set("")
+                    self.mocap_latency.set("")
+                    self.mocap_frame_gaps.set("")
+                self.camera_status.set(self.get_formatted_camera_status())
                 await asyncio.sleep(interval)
         finally:
             LOG.debug("gui: updater exit")
     
-    def get_formatted_time(self):
-        elapsed_time = self.mocap_recorder.elapsed_time()
+    def get_formatted_time(self, status):
+        elapsed_time = status.elapsed_time
         return time.strftime('%H:%M:%S', time.gmtime(elapsed_time))
     
-    def get_formatted_packet_count(self):
-        packet_count = self.mocap_recorder.packet_count
+    def get_formatted_packet_count(self, status):
+        packet_count = status.packet_count
         if packet_count > 1e6:
             millions = int(packet_count/1e6)
             rem = packet_count%1e6
@@ -90,6 +110,42 @@ class App(tk.Frame):
             formatted_count = str(packet_count)
         return formatted_count
         
+    def get_formatted_receiver_status(self, status):
+        stats = status.receiver_stats
+        return "Queue peak: {} packets, dropped: {}, batch: {:.1f} avg / {} max, {:.1f} ms avg / {:.1f} ms max".format(
+            stats.queue_high_water_mark,
+            stats.dropped_count,
+            stats.mean_batch_size(),
+            stats.max_batch_size,
+            stats.mean_batch_time() * 1000,
+            stats.max_batch_time * 1000,
+        )
+
+    def get_formatted_latency(self, status):
+        def fmt(stage):
+            summary = status.latency[stage]
+            if summary["count"] == 0:
+                return "-"
+            return "/".join("{:.1f}".format(summary[key] * 1000) for key in ["p50", "p95", "p99", "max"])
+        return ("Latency p50/p95/p99/max [ms]: transport {}, decode {}, frame push {},\n"
+            "angle trigger push {}, periodic trigger push {}").format(
+            fmt("qtm_to_arrival"), fmt("arrival_to_decoded"), fmt("arrival_to_frame_push"),
+            fmt("arrival_to_trigger_push"), fmt("trigger_deadline_to_push"),
+        )
+
+    def get_formatted_frame_gaps(self, status):
+        gaps = status.frame_gaps
+        return "Dropped frames: {} ({:.2%}) in {} gap(s), largest {}, stalls: {}".format(
+            gaps["frames_missing"],
+            gaps["missing_ratio"],
+            gaps["gap_count"],
+            gaps["largest_gap"],
+            gaps["stall_count"],
+        )
+
+    def get_formatted_camera_status(self):
+        return "\n".join(camera.status() for camera in self.cameras)
+
     def choose_folder(self):
         folder_path = filedialog.askdirectory()
         if folder_path:
@@ -136,6 +192,12 @@ class App(tk.Frame):
 
         self.label_unit = tk.Label(settings_frame, text=" degrees")
         self.label_unit.grid(row=row_number, column=1, sticky='e')
+
+        # Comma separated names of other LSL streams, e.g. EEG, to record with each trial.
+        self.lsl_streams = tk.StringVar(value="")
+        tk.Label(settings_frame, text="Also record LSL streams ").grid(row=row_number + 1, column=0, sticky='w')
+        self.lsl_streams_entry = tk.Entry(settings_frame, textvariable=self.lsl_streams, width=30)
+        self.lsl_streams_entry.grid(row=row_number + 1, column=1, columnspan=2, sticky='w')
         # -----------------------------------------------------------------------------------------------------
         mocap_status_frame = tk.Frame(self)
         mocap_status_frame.grid(row=0, column=1, columnspan=2, rowspan=3, sticky="nsew", padx=10, pady=10)
@@ -151,6 +213,22 @@ class App(tk.Frame):
         self.mocap_elapsed_time = tk.StringVar(value="")
         self.mocap_elapsed_time_label = tk.Label(mocap_status_frame, textvariable=self.mocap_elapsed_time)
         self.mocap_elapsed_time_label.grid(row=2, column=0, sticky='w')
+
+        self.mocap_receiver_status = tk.StringVar(value="")
+        self.mocap_receiver_status_label = tk.Label(mocap_status_frame, textvariable=self.mocap_receiver_status)
+        self.mocap_receiver_status_label.grid(row=3, column=0, sticky='w')
+
+        self.mocap_latency = tk.StringVar(value="")
+        self.mocap_latency_label = tk.Label(mocap_status_frame, textvariable=self.mocap_latency, justify='left')
+        self.mocap_latency_label.grid(row=4, column=0, sticky='w')
+
+        self.mocap_frame_gaps = tk.StringVar(value="")
+        self.mocap_frame_gaps_label = tk.Label(mocap_status_frame, textvariable=self.mocap_frame_gaps)
+        self.mocap_frame_gaps_label.grid(row=5, column=0, sticky='w')
+
+        self.camera_status = tk.StringVar(value="")
+        self.camera_status_label = tk.Label(mocap_status_frame, textvariable=self.camera_status, justify='left')
+        self.camera_status_label.grid(row=6, column=0, sticky='w')
         # -----------------------------------------------------------------------------------------------------
         self.interactive_frame = tk.Frame(self)
         self.interactive_frame.grid(row=row_number, rowspan=4, column=0, sticky="nsew")
@@ -166,8 +244,11 @@ class App(tk.Frame):
         self.canvas.config(scrollregion=(0, 200, self.canvas_width, self.canvas_height))
 
 
-        self.camera_label = tk.Label(self.camera_feed_frame)
-        self.camera_label.grid(row=row_number, column=2, sticky="w")
+        # One preview per camera, side by side.
+        self.camera_labels = []
+        for column in range(len(CAMERA_SOURCES)):
+            self.camera_labels.append(tk.Label(self.camera_feed_frame))
+            self.camera_labels[-1].grid(row=row_number, column=2 + column, sticky="w")
 
         self.draw_position_picker()
         self.capture_camera()
@@ -277,12 +358,31 @@ class App(tk.Frame):
         idx_to_angle = ['-90', '-45', '0', '45', '90']
         return idx_to_angle[self.baby_and_mother_idxs[0]]
     
+    def get_degree_step(self):
+        # The entry only accepts digits, but can be left empty or at 0.
+        degrees = self.degrees.get()
+        if degrees.isdigit() and int(degrees) > 0:
+            return int(degrees)
+        return mocap_recording.ANGLE_TRIGGER_STEP
+
+    def get_lsl_stream_names(self):
+        return [name.strip() for name in self.lsl_streams.get().split(",") if name.strip()]
+
     def get_mother_side(self):
         return 'right' if self.baby_and_mother_idxs[1] == 5 else 'left'
 
+    def recorded_trial_numbers(self):
+        trial_numbers = set()
+        for filename in os.listdir(self.target_folder):
+            parts = filename.split('_')
+            if len(parts) > 1 and parts[0] == 'trial' and parts[1].isdigit():
+                trial_numbers.add(int(parts[1]))
+        return trial_numbers
+
     def start_recording(self):
         self.participant_name_entry.config(state='readonly')
         self.degree_entry.config(state='readonly')
+        self.lsl_streams_entry.config(state='readonly')
         self.folder_button.config(state='disabled')
 
         self.phase_description.set("Recording In Progress")
@@ -290,21 +390,22 @@ class App(tk.Frame):
         if not os.path.exists(self.target_folder):
             os.makedirs(self.target_folder)
 
-        num_of_files_in_folder = len(os.listdir(self.target_folder))
+        recorded_trial_numbers = self.recorded_trial_numbers()
         # If for some reason the program was restarted after a few trials have been recorded,
         # we want the trial number to continue from where it stopped, not reset back to 1,
         # given that we don't want the experimenters to think about accidentally overwriting
         # the data (just quality of life things)
-        if num_of_files_in_folder != 0:
-            self.trial_number = int(num_of_files_in_folder / 2) + 1 # Dividing by 2 since we save video files as well
+        if recorded_trial_numbers:
+            # Taken from the trial numbers in the file names, since a trial saves a varying number of files.
+            self.trial_number = max(recorded_trial_numbers) + 1
         self.trial_number_str.set(f"Trial Number: {self.trial_number}")
         self.target_filename = f"trial_{self.trial_number}_babyAngle_{self.get_baby_angle()}_motherSide_{self.get_mother_side()}"
 
         # Video recording
-        frame_width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-        frame_height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-        self.video_recorder = cv2.VideoWriter(self.target_folder+self.target_filename+'.mp4', fourcc, 20.0, (frame_width, frame_height))
+        for camera in self.cameras:
+            camera.start_recording(self.target_folder + self.target_filename)
+        # Shown right away, a camera that cannot write its video says so in its status.
+        self.camera_status.set(self.get_formatted_camera_status())
 
         # Mocap recording
         self.started_mocap_recording = asyncio.ensure_future(self._start_mocap_recording())
@@ -319,14 +420,18 @@ class App(tk.Frame):
         try:
             err_msg = None
             self.mocap_recording_status.set("Connecting to Motion Capture software") 
-            self.mocap_recorder = await mocap_recording.init(
+            self.mocap_recorder = None
+            self.mocap_recorder = await asyncio.wrap_future(self.ingest.start_recorder(
                 qtm_host=host_ip,
                 qtm_port=port,
                 qtm_version=mocap_recording.QTM_DEFAULT_VERSION,
-                on_state_changed=self.mocap_state_update,
-                on_error=self.on_error,
-                starting_yaw=int(self.get_baby_angle())
-            )
+                on_state_changed=lambda new_state: self.call_in_gui(self.mocap_state_update, new_state),
+                on_error=lambda msg: self.call_in_gui(self.on_error, msg),
+                starting_yaw=int(self.get_baby_angle()),
+                filepath=self.target_folder + self.target_filename,
+                angle_step=self.get_degree_step(),
+                lsl_streams=self.get_lsl_stream_names(),
+            ))
         except asyncio.CancelledError:
             LOG.error("Start attempt canceled")
         except mocap_recording.LinkError as err:
@@ -343,6 +448,11 @@ class App(tk.Frame):
                     self.on_error(err_msg)
             self.started_mocap_recording = None
 
+    def call_in_gui(self, callback, *args):
+        # Recorder callbacks fire on the ingest thread, Tk may only be touched from this one.
+        if not self.async_loop.is_closed():
+            self.async_loop.call_soon_threadsafe(callback, *args)
+
     def on_error(self, msg):
         messagebox.showerror("Error", msg)
         self.stop_recording()
@@ -352,6 +462,9 @@ class App(tk.Frame):
             self.mocap_recording_status.set("")
             self.mocap_elapsed_time.set("")
             self.mocap_packet_number.set("")
+            self.mocap_receiver_status.set("")
+            self.mocap_latency.set("")
+            self.mocap_frame_gaps.set("")
         elif new_state == mocap_recording.State.WAITING:
             self.mocap_recording_status.set("Waiting on Motion Capture software")
         elif new_state == mocap_recording.State.STREAMING:
@@ -361,6 +474,7 @@ class App(tk.Frame):
             
     def stop_recording(self):
         self.degree_entry.config(state='normal')
+        self.lsl_streams_entry.config(state='normal')
         self.phase_description.set("Do you want to keep this trial or record over it?")
         self.stop_recording_button.grid_remove()
         self.continue_trial_button = tk.Button(self.interactive_frame, text="No, this was a bad trial. Record over it.", bg="darkred", fg="white", command=self.record_over_trial)
@@ -370,13 +484,32 @@ class App(tk.Frame):
         self.record_over_trial_button.grid(row=5, column=0, columnspan=1, sticky="ew", padx=5, pady=5)
 
         self.recording = False
-        if self.video_recorder:
-            self.video_recorder.release()
-            self.video_recorder = None
-        
+        mocap_shutdown = None
         if self.mocap_recorder:
-            asyncio.ensure_future(self.mocap_recorder.shutdown(self.target_folder + self.target_filename))
-    
+            mocap_shutdown = self.ingest.shutdown_recorder()
+
+        stopped_videos = [camera.stop_recording(self.target_folder + self.target_filename) for camera in self.cameras]
+        stopped_videos = [stopped for stopped in stopped_videos if stopped]
+        if stopped_videos:
+            asyncio.ensure_future(self.finish_videos(stopped_videos, mocap_shutdown))
+
+    async def finish_videos(self, stopped_videos, mocap_shutdown=None):
+        # Encoding the frames still queued can take a moment, the GUI keeps running meanwhile.
+        await asyncio.gather(*[
+            self.async_loop.run_in_executor(None, finish_video) for finish_video, _ in stopped_videos
+        ])
+        # The video indexes are linked to the mocap frames once the mocap trial is complete.
+        if mocap_shutdown is not None:
+            try:
+                await asyncio.wrap_future(mocap_shutdown)
+            except Exception as ex:
+                LOG.error("gui: mocap shutdown exception: " + repr(ex))
+        for _, finalize_index in stopped_videos:
+            try:
+                await self.async_loop.run_in_executor(None, finalize_index)
+            except Exception as ex:
+                LOG.error("gui: video index exception: " + repr(ex))
+
     def goto_new_trial(self):
         self.continue_trial_button.grid_remove()
         self.record_over_trial_button.grid_remove()
@@ -399,36 +532,19 @@ class App(tk.Frame):
         self.start_recording_button.grid(row=4, column=0, columnspan=1, sticky="ew", padx=5, pady=5)
 
     def capture_camera(self):
-        self.cap = cv2.VideoCapture(0, cv2.CAP_DSHOW)
+        # Frames are read on one capture thread per camera, this only shows them.
+        for camera_index, source in enumerate(CAMERA_SOURCES):
+            camera = TrialCamera(source, camera_index, len(CAMERA_SOURCES), VIDEO_CODEC)
+            camera.start()
+            self.cameras.append(camera)
+            self.previews.append(PreviewRenderer(
+                self.camera_labels[camera_index], self.canvas_width // len(CAMERA_SOURCES), self.canvas_height,
+            ))
 
         def update_feed():
-            ret, frame = self.cap.read()
-            if ret:
-                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                
-                frame_height, frame_width, _ = frame.shape
-                aspect_ratio = frame_width / frame_height
-
-                if self.canvas_width / self.canvas_height > aspect_ratio:
-                    new_width = int(self.canvas_height * aspect_ratio)
-                    new_height = self.canvas_height
-                else:
-                    new_width = self.canvas_width
-                    new_height = int(self.canvas_width / aspect_ratio)
-
-                if self.recording:
-                    writing_frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
-                    self.video_recorder.write(writing_frame)
-
-                frame = cv2.resize(frame, (new_width, new_height))
-                image = Image.fromarray(frame)
-                photo = ImageTk.PhotoImage(image=image)
-
-                self.camera_label.config(image=photo, width=new_width, height=new_height)
-                self.camera_label.image = photo
-
-
-            self.master.after(10, update_feed)
+            for camera, preview in zip(self.cameras, self.previews):
+                preview.render(camera.capture.latest())
+            self.master.after(self.previews[0].delay_ms(self.recording), update_feed)
         
         update_feed()
 
@@ -0,0 +1,103 @@
+"""
+    Bounded queue between the QTM packet callback and the stream receiver, with receiver metrics.
+"""
+
+import asyncio
+import collections
+from enum import Enum
+
+DEFAULT_MAXSIZE = 10000
+
+class OverflowPolicy(Enum):
+    DROP_OLDEST = 1
+    DROP_NEWEST = 2
+    STOP = 3
+
+class PacketQueue:
+    """
+        Unlike asyncio.Queue, the consumer takes everything that is pending in
+        one call, so a stalled receiver catches up in a few large batches.
+
+        on_overflow() is called for every packet that does not fit, whatever
+        the policy; with STOP the caller is expected to cancel the stream.
+    """
+    def __init__(self, maxsize=DEFAULT_MAXSIZE, overflow_policy=OverflowPolicy.DROP_OLDEST, on_overflow=None):
+        self.maxsize = maxsize
+        self.overflow_policy = overflow_policy
+        self._on_overflow = on_overflow
+        self.items = collections.deque()
+        self.ready = asyncio.Event()
+        self.closed = False
+        self.high_water_mark = 0
+        self.dropped_count = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def put_nowait(self, item):
+        if self.closed:
+            return
+        if len(self.items) >= self.maxsize:
+            self.dropped_count += 1
+            if self._on_overflow:
+                self._on_overflow()
+            if self.overflow_policy != OverflowPolicy.DROP_OLDEST:
+                return
+            self.items.popleft()
+        self.items.append(item)
+        if len(self.items) > self.high_water_mark:
+            self.high_water_mark = len(self.items)
+        self.ready.set()
+
+    def close(self):
+        self.closed = True
+        self.ready.set()
+
+    async def get_batch(self):
+        """
+            Wait for at least one item and return all pending items, or None
+            once the queue is closed and drained.
+        """
+        while not self.items:
+            if self.closed:
+                return None
+            self.ready.clear()
+            await self.ready.wait()
+        batch = list(self.items)
+        self.items.clear()
+        return batch
+
+class ReceiverStats:
+    def __init__(self):
+        self.queue_high_water_mark = 0
+        self.dropped_count = 0
+        self.batch_count = 0
+        self.packet_count = 0
+        self.last_batch_size = 0
+        self.max_batch_size = 0
+        self.last_batch_time = 0
+        self.max_batch_time = 0
+        self.total_batch_time = 0
+
+    def update_queue(self, queue):
+        self.queue_high_water_mark = queue.high_water_mark
+        self.dropped_count = queue.dropped_count
+
+    def add_batch(self, batch_size, processing_time):
+        self.batch_count += 1
+        self.packet_count += batch_size
+        self.last_batch_size = batch_size
+        self.max_batch_size = max(self.max_batch_size, batch_size)
+        self.last_batch_time = processing_time
+        self.max_batch_time = max(self.max_batch_time, processing_time)
+        self.total_batch_time += processing_time
+
+    def mean_batch_size(self):
+        if self.batch_count == 0:
+            return 0
+        return self.packet_count / self.batch_count
+
+    def mean_batch_time(self):
+        if self.batch_count == 0:
+            return 0
+        return self.total_batch_time / self.batch_count
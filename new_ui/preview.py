@@ -0,0 +1,65 @@
+"""
+    Camera preview for the GUI, drawn at its own rate into one reused Tk image.
+"""
+
+import cv2
+import numpy as np
+from PIL import Image, ImageTk
+
+PREVIEW_FPS = 30
+# While recording the preview steps back, leaving CPU to the encoder and the mocap ingest.
+RECORDING_PREVIEW_FPS = 10
+
+def fit_size(width, height, max_width, max_height):
+    # Largest (width, height) with the aspect ratio of the frame that fits the preview area.
+    aspect_ratio = width / height
+    if max_width / max_height > aspect_ratio:
+        return int(max_height * aspect_ratio), max_height
+    return max_width, int(max_width / aspect_ratio)
+
+class PreviewRenderer:
+    """
+        Shows the latest captured frame in a Tk label. The target size and
+        the scaled image buffers are computed once per camera resolution, the
+        frame is scaled down before it is converted to RGB, and each frame is
+        pasted into the same PhotoImage instead of creating a new one.
+
+        Call render() every delay_ms(); frames already shown are skipped.
+    """
+    def __init__(self, label, max_width, max_height, fps=PREVIEW_FPS, recording_fps=RECORDING_PREVIEW_FPS):
+        self.label = label
+        self.max_width = max_width
+        self.max_height = max_height
+        self.fps = fps
+        self.recording_fps = recording_fps
+        self.source_shape = None
+        self.size = None
+        self.resized = None
+        self.rgb = None
+        self.photo = None
+        self.shown_index = -1
+
+    def delay_ms(self, recording=False):
+        return max(int(1000 / (self.recording_fps if recording else self.fps)), 1)
+
+    def set_geometry(self, shape):
+        height, width = shape[:2]
+        self.source_shape = shape
+        self.size = fit_size(width, height, self.max_width, self.max_height)
+        new_width, new_height = self.size
+        self.resized = np.empty((new_height, new_width, 3), dtype=np.uint8)
+        self.rgb = np.empty_like(self.resized)
+        self.photo = ImageTk.PhotoImage("RGB", self.size)
+        self.label.config(image=self.photo, width=new_width, height=new_height)
+        self.label.image = self.photo
+
+    def render(self, frame):
+        if frame is None or frame.index == self.shown_index:
+            return False
+        if frame.image.shape != self.source_shape:
+            self.set_geometry(frame.image.shape)
+        cv2.resize(frame.image, self.size, dst=self.resized, interpolation=cv2.INTER_AREA)
+        cv2.cvtColor(self.resized, cv2.COLOR_BGR2RGB, dst=self.rgb)
+        self.photo.paste(Image.fromarray(self.rgb))
+        self.shown_index = frame.index
+        return True
@@ -0,0 +1,144 @@
+"""
+    One camera of the recording room: capture, trial video, video index and frame markers.
+"""
+
+from collections import namedtuple
+import logging
+import time
+
+import cv2
+from pylsl import local_clock
+
+from camera_capture import CameraCapture
+from video_encoder import DEFAULT_VIDEO_FPS, VideoEncoder
+import video_index
+from video_stream import VIDEO_STREAM_NAME, VideoFrameOutlet
+
+LOG = logging.getLogger("qlsl")
+
+VideoCodec = namedtuple("VideoCodec", "fourcc extension")
+# Codecs OpenCV can usually write, compare them on the recording computer
+# with benchmarks/video_codecs.py. Which ones work depends on the OpenCV build.
+VIDEO_CODECS = {
+    "mp4v": VideoCodec("mp4v", ".mp4"),
+    "h264": VideoCodec("avc1", ".mp4"),
+    "mjpg": VideoCodec("MJPG", ".avi"),
+    "xvid": VideoCodec("XVID", ".avi"),
+}
+DEFAULT_VIDEO_CODEC = "mp4v"
+
+def open_video_writer(filepath, codec, fps, frame_size):
+    writer = cv2.VideoWriter(filepath, cv2.VideoWriter_fourcc(*codec.fourcc), fps, frame_size)
+    if not writer.isOpened():
+        raise RuntimeError("OpenCV cannot write {} video to {}".format(codec.fourcc, filepath))
+    return writer
+
+def camera_filepath(filepath, camera_index, camera_count):
+    # With a single camera the files keep their original '<trial>.mp4' names.
+    if camera_count == 1:
+        return filepath
+    return f"{filepath}_camera{camera_index}"
+
+class TrialCamera:
+    """
+        Each camera has its own capture thread, running for the whole
+        session, and its own encoder thread per trial, so a slow camera or
+        encoder only drops its own frames. All frames are stamped on the
+        LSL clock, shared with the mocap data.
+    """
+    def __init__(self, source, camera_index, camera_count, codec=DEFAULT_VIDEO_CODEC):
+        if codec not in VIDEO_CODECS:
+            raise ValueError("Unknown video codec '{}', expected one of {}".format(codec, ", ".join(VIDEO_CODECS)))
+        self.name = "camera{}".format(camera_index)
+        self.codec = VIDEO_CODECS[codec]
+        self.camera_index = camera_index
+        self.camera_count = camera_count
+        self.capture = CameraCapture(lambda: cv2.VideoCapture(source, cv2.CAP_DSHOW), name=self.name)
+        self.outlet = None
+        self.encoder = None
+        self.filepath = None
+        # Why the last trial has no video, shown in the camera status.
+        self.error = None
+
+    def start(self):
+        self.capture.start()
+        stream_name = VIDEO_STREAM_NAME if self.camera_count == 1 else "{}_{}".format(VIDEO_STREAM_NAME, self.name)
+        # Frame markers of the trial videos on LSL, for EEG recorders.
+        self.outlet = VideoFrameOutlet(self.name, stream_name)
+
+    def stop(self):
+        self.capture.stop()
+
+    def start_recording(self, trial_filepath):
+        """
+            Returns False if the trial is recorded without this camera's video.
+        """
+        self.error = None
+        frame_size = self.capture.frame_size()
+        if frame_size is None:
+            LOG.warning("{}: no camera frames, the trial is recorded without its video".format(self.name))
+            self.error = "no camera frames"
+            return False
+        self.filepath = camera_filepath(trial_filepath, self.camera_index, self.camera_count)
+        video_filepath = self.filepath + self.codec.extension
+        # The rate the camera actually delivers, so the video plays back in real time.
+        fps = self.capture.fps() or DEFAULT_VIDEO_FPS
+        # Opened here rather than on the encoder thread, so a codec the OpenCV
+        # build cannot write is reported before the trial starts.
+        try:
+            writer = open_video_writer(video_filepath, self.codec, fps, frame_size)
+        except Exception as ex:
+            LOG.error("{}: the trial is recorded without its video: {}".format(self.name, ex))
+            self.error = "cannot write {} video".format(self.codec.fourcc)
+            return False
+        index = video_index.VideoIndex(self.filepath, video_filepath, fps, (local_clock(), time.time()))
+        index.open()
+        self.outlet.start_video()
+        self.encoder = VideoEncoder(
+            writer,
+            name="{}-encoder".format(self.name),
+            sinks=[index, self.outlet],
+        )
+        self.encoder.start()
+        # Every frame captured from now on goes straight from the capture thread to the encoder.
+        self.capture.add_consumer(self.encoder.submit)
+        return True
+
+    def stop_recording(self, trial_filepath):
+        """
+            Stop feeding the encoder. Returns two functions, or None if
+            nothing was recorded: finish_video() finishes the video and its
+            sidecars and blocks while the queued frames are encoded,
+            finalize_index() links the video index to the mocap trial once
+            that is complete.
+        """
+        if self.encoder is None:
+            return None
+        encoder, filepath = self.encoder, self.filepath
+        self.capture.remove_consumer(encoder.submit)
+        self.encoder = None
+
+        def finish_video():
+            encoder.stop()
+            encoder.save(f"{filepath}_video.json")
+            summary = encoder.summary()
+            LOG.info("{}: {} frames captured, {} encoded, {} dropped".format(
+                self.name, summary["frames_captured"], summary["frames_encoded"], summary["frames_dropped"],
+            ))
+
+        def finalize_index():
+            video_index.finalize(filepath, trial_filepath)
+        return finish_video, finalize_index
+
+    def status(self):
+        if not self.capture.is_running():
+            return "{}: not available".format(self.name)
+        fps = self.capture.fps()
+        if fps is None:
+            return "{}: starting".format(self.name)
+        status = "{}: {:.1f} fps".format(self.name, fps)
+        if self.error:
+            status += ", no video ({})".format(self.error)
+        if self.encoder:
+            status += ", {} dropped".format(self.encoder.dropped_count)
+        return status
@@ -0,0 +1,274 @@
+"""
+    Binary trial format written while recording, and conversion to the per-body CSV files.
+
+    Layout of a .trial file:
+        8 bytes     magic b"BSKTRIAL"
+        uint32      format version
+        uint32      header length in bytes
+        header      UTF-8 JSON, padded with spaces so the records start on a 64 byte boundary
+        records     fixed-size little-endian records, one per frame, until the end of the file
+
+    The header lists the record fields, so readers build the record dtype from
+    the file itself. Besides mocap trials, the same layout holds other LSL
+    streams recorded with a trial, whose header has a "stream" entry instead
+    of "bodies". Records are appended as the trial runs, so the number of
+    frames is derived from the file size and a trial cut short by a crash is
+    still readable.
+"""
+
+import csv
+import json
+import os
+import struct
+import sys
+import time
+
+import numpy as np
+
+from clock_sync import QtmClock, clock_sync_filepath
+
+MAGIC = b"BSKTRIAL"
+VERSION = 1
+PREAMBLE = struct.Struct("<8sII")
+ALIGNMENT = 64
+TRIAL_EXTENSION = ".trial"
+CHANNELS = ['x', 'y', 'z', 'roll', 'pitch', 'yaw']
+MARKER_CHANNELS = ['x', 'y', 'z']
+CSV_HEADER = ['timestamp'] + CHANNELS
+EXPORT_CHUNK_SIZE = 65536
+
+class TrialFormatError(Exception):
+    pass
+
+def record_dtype(body_count, marker_count=0):
+    # float64 keeps values bit-identical to what the CSV export writes.
+    fields = [
+        ('time', '<f8'),
+        ('qtm_timestamp', '<i8'),
+        ('frame_number', '<i8'),
+        ('data', '<f8', (body_count, len(CHANNELS))),
+    ]
+    if marker_count:
+        fields.append(('markers', '<f8', (marker_count, len(MARKER_CHANNELS))))
+    return np.dtype(fields)
+
+def stream_record_dtype(value_type, channel_count):
+    return np.dtype([
+        ('time', '<f8'),
+        ('data', value_type, (channel_count,)),
+    ])
+
+def dtype_to_fields(dtype):
+    return [[name, dtype.fields[name][0].base.str, list(dtype.fields[name][0].shape)] for name in dtype.names]
+
+def fields_to_dtype(fields):
+    return np.dtype([(name, base, tuple(shape)) for name, base, shape in fields])
+
+def new_header(body_names, euler, frequency, starting_yaw, clock_anchor, marker_names=()):
+    lsl_anchor, wall_anchor = clock_anchor
+    return {
+        "bodies": list(body_names),
+        "channels": CHANNELS,
+        "markers": list(marker_names),
+        "euler": euler,
+        "frequency": frequency,
+        "starting_yaw": starting_yaw,
+        "clock_anchor": {"lsl": lsl_anchor, "wall": wall_anchor},
+    }
+
+def new_stream_header(stream, clock_anchor):
+    """
+        stream describes the LSL stream: name, type, source_id, channel_count,
+        nominal_srate, channel_format and channel labels.
+    """
+    lsl_anchor, wall_anchor = clock_anchor
+    return {
+        "stream": stream,
+        "clock_anchor": {"lsl": lsl_anchor, "wall": wall_anchor},
+    }
+
+def encode_header(header, dtype):
+    header = dict(header, version=VERSION)
+    header["fields"] = dtype_to_fields(dtype)
+    header["record_size"] = dtype.itemsize
+    encoded = json.dumps(header).encode("utf-8")
+    padding = -(PREAMBLE.size + len(encoded)) % ALIGNMENT
+    encoded += b" " * padding
+    return PREAMBLE.pack(MAGIC, VERSION, len(encoded)) + encoded
+
+def read_header(file):
+    preamble = file.read(PREAMBLE.size)
+    if len(preamble) < PREAMBLE.size:
+        raise TrialFormatError("File too short to be a trial file")
+    magic, version, header_length = PREAMBLE.unpack(preamble)
+    if magic != MAGIC:
+        raise TrialFormatError("Not a trial file")
+    if version != VERSION:
+        raise TrialFormatError("Unsupported trial format version {}".format(version))
+    header = json.loads(file.read(header_length).decode("utf-8"))
+    return header, PREAMBLE.size + header_length
+
+class TrialFile:
+    """
+        Append-only writer for a .trial file. dtype defaults to the mocap
+        record of the bodies and markers in the header.
+    """
+    def __init__(self, filepath, header, dtype=None):
+        self.filepath = filepath
+        self.header = header
+        if dtype is None:
+            dtype = record_dtype(len(header["bodies"]), len(header.get("markers", [])))
+        self.dtype = dtype
+        self.file = None
+        self.frame_count = 0
+
+    def open(self):
+        self.file = open(self.filepath, 'wb')
+        self.file.write(encode_header(self.header, self.dtype))
+        self.file.flush()
+
+    def append(self, **fields):
+        """
+            One frames-first array per record field, e.g. data of shape (frames, bodies, channels).
+        """
+        records = np.empty(len(fields['time']), dtype=self.dtype)
+        for name, values in fields.items():
+            records[name] = values
+        self.file.write(records.tobytes())
+        self.file.flush()
+        self.frame_count += len(records)
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+def load_trial(filepath):
+    """
+        Memory-map a .trial file. Returns the header and a structured array with
+        one record per frame; channel c of body b is records['data'][:, b, c],
+        and x, y, z of marker m are records['markers'][:, m, :] if the trial has markers.
+    """
+    with open(filepath, 'rb') as file:
+        header, offset = read_header(file)
+    dtype = fields_to_dtype(header["fields"])
+    frame_count = (os.path.getsize(filepath) - offset) // dtype.itemsize
+    if frame_count == 0:
+        return header, np.empty(0, dtype=dtype)
+    records = np.memmap(filepath, dtype=dtype, mode='r', offset=offset, shape=(frame_count,))
+    return header, records
+
+def wall_times(header, times):
+    anchor = header["clock_anchor"]
+    return anchor["wall"] + (times - anchor["lsl"])
+
+def format_timestamps(wall_times):
+    """
+        Format epoch seconds as local 'YYYY-MM-DDTHH:MM:SS.fffff' strings, the
+        timestamp layout of the CSV files.
+    """
+    seconds = np.floor(wall_times)
+    utc_offsets = [time.localtime(seconds[0]).tm_gmtoff, time.localtime(seconds[-1]).tm_gmtoff]
+    if utc_offsets[0] != utc_offsets[1]:
+        # The trial crosses a daylight saving change, fall back to per frame offsets.
+        utc_offsets = np.array([time.localtime(second).tm_gmtoff for second in seconds.tolist()])
+    else:
+        utc_offsets = utc_offsets[0]
+    local_seconds = (seconds + utc_offsets).astype(np.int64).astype('datetime64[s]')
+    # The old str(fraction)[1:7] slicing kept five truncated digits.
+    fractions = ((wall_times - seconds) * 1e5).astype(np.int64)
+    return np.char.add(
+        np.datetime_as_string(local_seconds),
+        np.char.mod('.%05d', fractions),
+    )
+
+def body_csv_filepath(filepath, body_name):
+    return f"{filepath}_{body_name}.csv"
+
+def markers_csv_filepath(filepath):
+    return f"{filepath}_markers.csv"
+
+def markers_csv_header(marker_names):
+    return ['timestamp'] + [
+        "{}_{}".format(marker_name, channel) for marker_name in marker_names for channel in MARKER_CHANNELS
+    ]
+
+def stream_csv_header(stream):
+    labels = stream.get("channels") or []
+    if len(labels) != stream["channel_count"]:
+        labels = ["channel_{}".format(index) for index in range(stream["channel_count"])]
+    return ['timestamp'] + labels
+
+def export_stream_csv(header, records, filepath):
+    csv_filepath = f"{filepath}.csv"
+    with open(csv_filepath, 'w', newline='') as file:
+        csv_writer = csv.writer(file)
+        csv_writer.writerow(stream_csv_header(header["stream"]))
+        for start in range(0, len(records), EXPORT_CHUNK_SIZE):
+            chunk = records[start:start + EXPORT_CHUNK_SIZE]
+            timestamps = format_timestamps(wall_times(header, chunk['time'])).tolist()
+            samples = chunk['data'].tolist()
+            csv_writer.writerows([timestamp] + sample for timestamp, sample in zip(timestamps, samples))
+    return [csv_filepath]
+
+def export_csv(trial_filepath, filepath=None):
+    """
+        Write one '<filepath>_<body>.csv' per rigid body, in the layout the
+        recorder has always produced, and '<filepath>_markers.csv' with every
+        labelled marker if the trial has markers. Timestamps are corrected
+        with '<filepath>_clock.json' when it exists. A recorded LSL stream is
+        written to '<filepath>.csv'. Returns the paths written.
+    """
+    if filepath is None:
+        filepath = trial_filepath[:-len(TRIAL_EXTENSION)] if trial_filepath.endswith(TRIAL_EXTENSION) else trial_filepath
+    header, records = load_trial(trial_filepath)
+    if "video" in header:
+        raise TrialFormatError("A video index, export it with video_index.export_csv")
+    if "stream" in header:
+        return export_stream_csv(header, records, filepath)
+    # With the clock fit saved next to the trial, timestamps are the QTM
+    # capture times on the LSL clock rather than the arrival times.
+    clock = None
+    if os.path.exists(clock_sync_filepath(filepath)):
+        clock = QtmClock.load(clock_sync_filepath(filepath))
+    csv_filepaths = []
+    files = []
+    try:
+        csv_writers = []
+        for body_name in header["bodies"]:
+            csv_filepaths.append(body_csv_filepath(filepath, body_name))
+            files.append(open(csv_filepaths[-1], 'w', newline=''))
+            csv_writers.append(csv.writer(files[-1]))
+            csv_writers[-1].writerow(CSV_HEADER)
+        markers_writer = None
+        if 'markers' in records.dtype.names:
+            csv_filepaths.append(markers_csv_filepath(filepath))
+            files.append(open(csv_filepaths[-1], 'w', newline=''))
+            markers_writer = csv.writer(files[-1])
+            markers_writer.writerow(markers_csv_header(header["markers"]))
+        for start in range(0, len(records), EXPORT_CHUNK_SIZE):
+            chunk = records[start:start + EXPORT_CHUNK_SIZE]
+            times = chunk['time'] if clock is None else clock.to_lsl(chunk['qtm_timestamp'])
+            timestamps = format_timestamps(wall_times(header, times)).tolist()
+            for body, csv_writer in enumerate(csv_writers):
+                # tolist() yields Python floats, so values are written as repr() like csv always did.
+                samples = chunk['data'][:, body, :].tolist()
+                csv_writer.writerows([timestamp] + sample for timestamp, sample in zip(timestamps, samples))
+            if markers_writer:
+                samples = chunk['markers'].reshape(len(chunk), -1).tolist()
+                markers_writer.writerows([timestamp] + sample for timestamp, sample in zip(timestamps, samples))
+    finally:
+        for file in files:
+            file.close()
+    return csv_filepaths
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: python trial_format.py <trial file> [<trial file> ...]")
+        sys.exit(1)
+    for trial_filepath in sys.argv[1:]:
+        for csv_filepath in export_csv(trial_filepath):
+            print(csv_filepath)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+    Write mocap frames to disk incrementally while a trial is being recorded.
+"""
+
+import logging
+
+import numpy as np
+
+from trial_format import (
+    TRIAL_EXTENSION,
+    TrialFile,
+    export_csv,
+    new_header,
+)
+
+LOG = logging.getLogger("qlsl")
+
+NAN_WARNING_RATIO = 0.33
+
+class TrialWriter:
+    """
+        Appends each chunk of frames from a FrameBuffer to the binary .trial
+        file, so a crash only loses the frames that were not yet written.
+        finalize() converts the trial to the per-body CSV files.
+    """
+    def __init__(self, filepath, config, starting_yaw, clock_anchor):
+        self.filepath = filepath
+        self.body_names = [body["name"] for body in config.bodies()]
+        self.marker_names = list(config.markers())
+        header = new_header(
+            self.body_names,
+            config.the_6d.get("euler", {}),
+            config.general.get("frequency"),
+            starting_yaw,
+            clock_anchor,
+            self.marker_names,
+        )
+        self.trial_file = TrialFile(filepath + TRIAL_EXTENSION, header)
+        self.frame_count = 0
+        self.nan_counts = np.zeros(len(self.body_names), dtype=np.int64)
+
+    def open(self):
+        self.trial_file.open()
+
+    def write(self, frames):
+        length = len(frames)
+        if length == 0:
+            return
+        data = frames.data[:, :, :length]
+        fields = dict(
+            time=frames.times[:length],
+            qtm_timestamp=frames.qtm_timestamps[:length],
+            frame_number=frames.frame_numbers[:length],
+            data=np.moveaxis(data, -1, 0),
+        )
+        if self.marker_names:
+            fields["markers"] = np.moveaxis(frames.markers[:, :, :length], -1, 0)
+        self.trial_file.append(**fields)
+        self.nan_counts += np.count_nonzero(np.isnan(data[:, 0, :]), axis=-1)
+        self.frame_count += length
+
+    def finalize(self):
+        self.trial_file.close()
+        export_csv(self.trial_file.filepath, self.filepath)
+        if self.frame_count == 0:
+            return
+        for body_name, nan_count in zip(self.body_names, self.nan_counts.tolist()):
+            nan_percentage = nan_count / self.frame_count
+            if nan_percentage > NAN_WARNING_RATIO:
+                LOG.warning(f"More than 30% of the motion capture data for {body_name} is lost. Consider rerecording this trial!")
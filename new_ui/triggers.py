@@ -0,0 +1,163 @@
+"""
+    LSL triggers: periodic scheduling and detection of yaw threshold crossings.
+"""
+
+import logging
+import threading
+
+import numpy as np
+from pylsl import local_clock
+
+LOG = logging.getLogger("qlsl")
+
+PERIODIC_TRIGGER_PERIOD = 1.0
+PERIODIC_TRIGGER_VALUE = 1
+ANGLE_TRIGGER_STEP = 10
+
+def wrap_angle(degrees):
+    # Into (-180, 180]
+    return 180 - np.mod(180 - degrees, 360)
+
+class PeriodicTriggers:
+    """
+        Calls push(value, timestamp) every period seconds from a background
+        thread. Deadlines are start + n * period on the LSL clock, so the time
+        spent pushing never accumulates, and each trigger is stamped with its
+        deadline rather than the moment it was pushed. Ticks missed while the
+        thread was held up are pushed late, still with their own deadlines.
+
+        clock and wait can be replaced to run on simulated time: wait(delay)
+        blocks for up to delay seconds and returns True once stop() is called.
+    """
+    def __init__(self, push, first_value, value=PERIODIC_TRIGGER_VALUE, period=PERIODIC_TRIGGER_PERIOD,
+            clock=local_clock, wait=None):
+        if period <= 0:
+            raise ValueError("period must be positive, got {}".format(period))
+        self.push = push
+        self.first_value = first_value
+        self.value = value
+        self.period = period
+        self.clock = clock
+        self.stop_event = threading.Event()
+        self.wait = wait or self.stop_event.wait
+        self.thread = None
+        self.start_time = None
+        self.tick = 0
+
+    def is_started(self):
+        return self.thread is not None or self.stop_event.is_set()
+
+    def start(self, start_time=None):
+        """
+            Tick 0 is due at start_time on the LSL clock, by default now. A
+            start_time in the past pushes the ticks already due right away.
+        """
+        self.start_time = self.clock() if start_time is None else start_time
+        self.thread = threading.Thread(target=self.run, name="periodic-triggers", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
+
+    def deadline(self, tick):
+        return self.start_time + tick * self.period
+
+    def run(self):
+        if self.start_time is None:
+            self.start_time = self.clock()
+        while not self.stop_event.is_set():
+            delay = self.deadline(self.tick) - self.clock()
+            if delay > 0 and self.wait(delay):
+                break
+            if self.stop_event.is_set():
+                break
+            # A late wakeup can find several deadlines already passed.
+            now = self.clock()
+            while self.deadline(self.tick) <= now:
+                value = self.first_value if self.tick == 0 else self.value
+                self.push(value, self.deadline(self.tick))
+                LOG.debug("pushed periodic sample {}".format(value))
+                self.tick += 1
+
+class AngleTriggerDetector:
+    """
+        Finds every crossing of a multiple of step degrees, relative to the
+        starting yaw, between consecutive frames of each body. Yaw is unwrapped
+        across +-180, so a turn from 175 to -175 crosses 180. NaN frames are
+        skipped and the crossing is found between the valid frames around them.
+        The crossing time is interpolated linearly between the two frames.
+
+        As before, a body crossing the same threshold again without crossing
+        another one in between (jitter around the threshold) is not reported.
+    """
+    def __init__(self, body_count, step=ANGLE_TRIGGER_STEP, starting_yaw=0):
+        if step <= 0:
+            raise ValueError("step must be positive, got {}".format(step))
+        self.step = step
+        self.starting_yaw = starting_yaw
+        # Per body: last valid unwrapped relative yaw and its time, and the last value reported.
+        self.last_angles = [None] * body_count
+        self.last_times = [None] * body_count
+        self.last_values = [None] * body_count
+
+    def detect(self, yaws, times):
+        """
+            yaws has shape (frames, bodies) in degrees, times shape (frames,).
+            Returns frame indices, values (relative threshold angles in
+            (-180, 180]) and interpolated times of the crossings, in time order.
+        """
+        yaws = np.asarray(yaws, dtype=np.float64)
+        times = np.asarray(times, dtype=np.float64)
+        crossings = [self.detect_body(body, yaws[:, body], times) for body in range(yaws.shape[1])]
+        if not crossings:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0)
+        bodies = np.concatenate([np.full(len(crossing[0]), body) for body, crossing in enumerate(crossings)])
+        frame_indices, values, crossing_times = (np.concatenate(column) for column in zip(*crossings))
+        order = np.argsort(crossing_times, kind='stable')
+        return self.drop_repeats(bodies[order], frame_indices[order], values[order], crossing_times[order])
+
+    def detect_body(self, body, yaws, times):
+        frame_indices = np.flatnonzero(~np.isnan(yaws))
+        if frame_indices.size == 0:
+            return frame_indices, frame_indices.copy(), np.empty(0)
+        relative = yaws[frame_indices] - self.starting_yaw
+        steps = wrap_angle(np.diff(relative))
+        if self.last_angles[body] is None:
+            angles = wrap_angle(relative[0]) + np.concatenate(([0], np.cumsum(steps)))
+            sample_times = times[frame_indices]
+            sample_frames = frame_indices
+        else:
+            first_step = wrap_angle(relative[0] - self.last_angles[body])
+            angles = self.last_angles[body] + np.cumsum(np.concatenate(([0, first_step], steps)))
+            sample_times = np.concatenate(([self.last_times[body]], times[frame_indices]))
+            sample_frames = np.concatenate(([-1], frame_indices))
+        self.last_angles[body] = float(angles[-1])
+        self.last_times[body] = float(sample_times[-1])
+
+        # Each multiple of step starts a bin, a crossing is a move to another bin.
+        bins = np.floor(angles / self.step).astype(np.int64)
+        jumps = np.diff(bins)
+        counts = np.abs(jumps)
+        total = int(counts.sum())
+        if total == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0)
+        # One entry per crossed threshold, from the sample before the crossing.
+        before = np.repeat(np.arange(len(jumps)), counts)
+        nth = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        upward = jumps[before] > 0
+        thresholds = np.where(upward, bins[before] + 1 + nth, bins[before] - nth) * self.step
+        fractions = (thresholds - angles[before]) / (angles[before + 1] - angles[before])
+        crossing_times = sample_times[before] + fractions * (sample_times[before + 1] - sample_times[before])
+        values = np.rint(wrap_angle(thresholds)).astype(np.int64)
+        return sample_frames[before + 1], values, crossing_times
+
+    def drop_repeats(self, bodies, frame_indices, values, crossing_times):
+        keep = np.ones(len(values), dtype=bool)
+        for index, (body, value) in enumerate(zip(bodies.tolist(), values.tolist())):
+            if self.last_values[body] == value:
+                keep[index] = False
+            self.last_values[body] = value
+        return frame_indices[keep], values[keep], crossing_times[keep]
@@ -0,0 +1,111 @@
+"""
+    Encode video frames on a background thread, fed through a bounded queue with drop accounting.
+"""
+
+import json
+import logging
+import queue
+import threading
+import time
+
+LOG = logging.getLogger("qlsl")
+
+# About two seconds of 30 fps video.
+ENCODER_QUEUE_SIZE = 60
+# Used while the camera frame rate has not been measured yet.
+DEFAULT_VIDEO_FPS = 20.0
+
+class VideoEncoder:
+    """
+        submit() never blocks, it is called from the camera capture thread for
+        every frame while recording. A frame that finds the queue full is
+        dropped and counted. Frames are written exactly as captured (BGR).
+
+        writer is an opened cv2.VideoWriter (or anything with write and
+        release), so a codec that cannot be written fails before recording
+        starts. It is written to and released on the encoder thread. OpenCV
+        releases the GIL while encoding, so a thread is enough to keep it off
+        the GUI and the mocap loop.
+
+        Every frame written is also passed to append() of each sink, e.g. a
+        VideoIndex, in video order; close() is called on them at the end.
+    """
+    def __init__(self, writer, maxsize=ENCODER_QUEUE_SIZE, name="video-encoder", sinks=()):
+        self.writer = writer
+        self.sinks = list(sinks)
+        self.queue = queue.Queue(maxsize)
+        self.name = name
+        self.thread = None
+        self.captured_count = 0
+        self.encoded_count = 0
+        self.dropped_count = 0
+        self.failed_count = 0
+        self.high_water_mark = 0
+        self.encode_time = 0.0
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name=self.name, daemon=True)
+        self.thread.start()
+
+    def submit(self, frame):
+        self.captured_count += 1
+        try:
+            self.queue.put_nowait(frame)
+        except queue.Full:
+            self.dropped_count += 1
+            return False
+        self.high_water_mark = max(self.high_water_mark, self.queue.qsize())
+        return True
+
+    def stop(self):
+        """
+            Encode the frames still queued, then close the file. Blocks until done.
+        """
+        if self.thread is None:
+            return
+        if self.thread.is_alive():
+            self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+
+    def run(self):
+        try:
+            while True:
+                frame = self.queue.get()
+                if frame is None:
+                    break
+                start = time.perf_counter()
+                try:
+                    self.writer.write(frame.image)
+                except Exception as ex:
+                    self.failed_count += 1
+                    LOG.error("{}: write exception: ".format(self.name) + repr(ex))
+                    continue
+                self.encode_time += time.perf_counter() - start
+                self.encoded_count += 1
+                for sink in self.sinks:
+                    sink.append(frame)
+        except Exception as ex:
+            LOG.error("{}: exception: ".format(self.name) + repr(ex))
+        finally:
+            self.writer.release()
+            for sink in self.sinks:
+                try:
+                    sink.close()
+                except Exception as ex:
+                    LOG.error("{}: sink close exception: ".format(self.name) + repr(ex))
+
+    def summary(self):
+        return {
+            "frames_captured": self.captured_count,
+            "frames_encoded": self.encoded_count,
+            "frames_dropped": self.dropped_count,
+            "frames_failed": self.failed_count,
+            "queue_size": self.queue.maxsize,
+            "queue_high_water_mark": self.high_water_mark,
+            "mean_encode_time": self.encode_time / self.encoded_count if self.encoded_count else None,
+        }
+
+    def save(self, filepath):
+        with open(filepath, 'w') as file:
+            json.dump(self.summary(), file, indent=2)
@@ -0,0 +1,141 @@
+"""
+    Per-frame index of a trial video: capture time of every encoded frame and the nearest mocap frame.
+
+    The index is a .trial file (see trial_format) with a "video" header entry
+    and one record per frame of the video, so record i describes video frame i:
+        time            capture time on the LSL clock
+        capture_index   index of the frame among all frames the camera captured,
+                        gaps are frames dropped before encoding
+        mocap_frame     record of the mocap .trial file (row of the CSV files)
+                        closest in time, -1 until linked or without mocap data
+"""
+
+import csv
+import os
+
+import numpy as np
+
+from clock_sync import QtmClock, clock_sync_filepath
+from trial_format import (
+    TRIAL_EXTENSION,
+    TrialFile,
+    format_timestamps,
+    load_trial,
+    read_header,
+    wall_times,
+)
+
+VIDEO_INDEX_DTYPE = np.dtype([
+    ('time', '<f8'),
+    ('capture_index', '<i8'),
+    ('mocap_frame', '<i8'),
+])
+# Frames buffered before a write, about a second of video.
+FLUSH_FRAMES = 30
+
+def video_index_filepath(filepath):
+    return f"{filepath}_video_index{TRIAL_EXTENSION}"
+
+def nearest_frames(times, query_times):
+    """
+        Index of the element of the sorted times closest to each query time, by binary search.
+    """
+    times = np.asarray(times)
+    query_times = np.asarray(query_times)
+    if times.size == 0:
+        return np.full(query_times.shape, -1, dtype=np.int64)
+    after = np.clip(np.searchsorted(times, query_times), 0, times.size - 1)
+    before = np.clip(after - 1, 0, times.size - 1)
+    closer_before = np.abs(query_times - times[before]) <= np.abs(times[after] - query_times)
+    return np.where(closer_before, before, after).astype(np.int64)
+
+def video_frame_at(records, time):
+    # The video frame showing the given LSL time: the last one captured at or before it.
+    return max(int(np.searchsorted(records['time'], time, side='right')) - 1, 0)
+
+class VideoIndex:
+    """
+        Written by the encoder thread as frames are encoded, so it matches the
+        video frame for frame even if recording is cut short.
+    """
+    def __init__(self, filepath, video_filepath, fps, clock_anchor):
+        lsl_anchor, wall_anchor = clock_anchor
+        header = {
+            "video": {"filepath": os.path.basename(video_filepath), "fps": fps},
+            "clock_anchor": {"lsl": lsl_anchor, "wall": wall_anchor},
+        }
+        self.trial_file = TrialFile(video_index_filepath(filepath), header, VIDEO_INDEX_DTYPE)
+        self.times = []
+        self.capture_indices = []
+
+    def open(self):
+        self.trial_file.open()
+
+    def append(self, frame):
+        self.times.append(frame.time)
+        self.capture_indices.append(frame.index)
+        if len(self.times) >= FLUSH_FRAMES:
+            self.flush()
+
+    def flush(self):
+        if not self.times:
+            return
+        self.trial_file.append(time=self.times, capture_index=self.capture_indices, mocap_frame=-1)
+        self.times = []
+        self.capture_indices = []
+
+    def close(self):
+        if self.trial_file.file:
+            self.flush()
+            self.trial_file.close()
+
+def mocap_times(filepath):
+    # Mocap frame times on the LSL clock, as in the exported CSV files.
+    _, records = load_trial(filepath + TRIAL_EXTENSION)
+    if os.path.exists(clock_sync_filepath(filepath)):
+        return QtmClock.load(clock_sync_filepath(filepath)).to_lsl(records['qtm_timestamp'])
+    return np.array(records['time'])
+
+def link_mocap(filepath, mocap_filepath=None):
+    """
+        Fill in the mocap_frame column of the video index at filepath, once
+        the mocap .trial file at mocap_filepath (by default the same) is complete.
+    """
+    if mocap_filepath is None:
+        mocap_filepath = filepath
+    index_filepath = video_index_filepath(filepath)
+    if not os.path.exists(mocap_filepath + TRIAL_EXTENSION):
+        return
+    times = mocap_times(mocap_filepath)
+    with open(index_filepath, 'rb') as file:
+        _, offset = read_header(file)
+    frame_count = (os.path.getsize(index_filepath) - offset) // VIDEO_INDEX_DTYPE.itemsize
+    if frame_count == 0:
+        return
+    records = np.memmap(index_filepath, dtype=VIDEO_INDEX_DTYPE, mode='r+', offset=offset, shape=(frame_count,))
+    records['mocap_frame'] = nearest_frames(times, records['time'])
+    records.flush()
+    del records
+
+def export_csv(filepath):
+    """
+        Write '<filepath>_video_index.csv' with one row per video frame. Returns the path written.
+    """
+    header, records = load_trial(video_index_filepath(filepath))
+    csv_filepath = f"{filepath}_video_index.csv"
+    with open(csv_filepath, 'w', newline='') as file:
+        csv_writer = csv.writer(file)
+        csv_writer.writerow(['frame', 'timestamp', 'capture_index', 'mocap_frame'])
+        if len(records):
+            timestamps = format_timestamps(wall_times(header, records['time'])).tolist()
+            csv_writer.writerows(zip(
+                range(len(records)), timestamps, records['capture_index'].tolist(), records['mocap_frame'].tolist(),
+            ))
+    return csv_filepath
+
+def finalize(filepath, mocap_filepath=None):
+    """
+        Link the video index to the mocap trial and export it to CSV, once both are complete.
+    """
+    link_mocap(filepath, mocap_filepath)
+    return export_csv(filepath)
@@ -0,0 +1,65 @@
+"""
+    LSL stream of video frame markers, to align the trial video with mocap and EEG.
+"""
+
+import socket
+
+from pylsl import StreamInfo, StreamOutlet, cf_int32
+
+VIDEO_STREAM_NAME = "trial_video"
+VIDEO_STREAM_CHANNELS = ["video_frame", "capture_index"]
+# Frames sent together; timestamps are exact regardless, this only delays live consumers.
+VIDEO_MARKER_CHUNK = 5
+
+def new_lsl_video_stream_info(camera_name, name=VIDEO_STREAM_NAME):
+    info = StreamInfo(
+        name=name,
+        type="VideoFrames",
+        channel_count=len(VIDEO_STREAM_CHANNELS),
+        channel_format=cf_int32,
+        source_id="{}:{}".format(socket.gethostname(), camera_name),
+    )
+    channels = info.desc().append_child("channels")
+    for label in VIDEO_STREAM_CHANNELS:
+        channel = channels.append_child("channel")
+        channel.append_child_value("label", label)
+        channel.append_child_value("type", "Index")
+    info.desc().append_child_value("camera", camera_name)
+    return info
+
+class VideoFrameOutlet:
+    """
+        Publishes each frame written to the trial video as (video frame
+        number, capture index), stamped with its capture time on the LSL
+        clock. The outlet lives as long as the camera, so recorders see one
+        stream across trials; frame numbers restart at 0 with every video.
+
+        Used as a VideoEncoder sink, so frames are pushed from the encoder
+        thread. Samples are queued with pushthrough off and sent together
+        every VIDEO_MARKER_CHUNK frames, since pylsl can only stamp a chunk
+        pushed in one call with a single timestamp.
+    """
+    def __init__(self, camera_name, name=VIDEO_STREAM_NAME, chunk_frames=VIDEO_MARKER_CHUNK):
+        self.outlet = StreamOutlet(new_lsl_video_stream_info(camera_name, name))
+        self.chunk_frames = chunk_frames
+        self.frame_number = 0
+        self.pending = []
+
+    def start_video(self):
+        self.frame_number = 0
+        self.pending = []
+
+    def append(self, frame):
+        self.pending.append(([self.frame_number, frame.index], frame.time))
+        self.frame_number += 1
+        if len(self.pending) >= self.chunk_frames:
+            self.flush()
+
+    def flush(self):
+        for number, (sample, timestamp) in enumerate(self.pending, start=1):
+            self.outlet.push_sample(sample, timestamp, pushthrough=number == len(self.pending))
+        self.pending = []
+
+    def close(self):
+        # End of the video: send what is left, the outlet stays open for the next one.
+        self.flush()
@@ -0,0 +1,165 @@
+from fractions import Fraction
+import random
+import statistics
+import threading
+
+import numpy as np
+import pytest
+
+from triggers import PERIODIC_TRIGGER_PERIOD, AngleTriggerDetector, PeriodicTriggers, wrap_angle
+
+START_TIME = 51234.567
+PERIOD = PERIODIC_TRIGGER_PERIOD
+# An hour of triggers.
+TICK_COUNT = int(3600 / PERIOD)
+OVERSLEEP = 0.02
+PUSH_COST = 0.005
+MAX_STALL = 6 * PERIOD
+# Longest possible wait behind a stall, oversleep and the pushes caught up after it.
+MAX_LATENESS = MAX_STALL + OVERSLEEP + (MAX_STALL / PERIOD + 2) * PUSH_COST
+
+class SimulatedTime:
+    """
+        Clock and wait for PeriodicTriggers on simulated time. Every wait
+        oversleeps a little and now and then stalls for several periods,
+        every push takes some time. Once count pushes are done, wait blocks
+        until the triggers are stopped.
+    """
+    def __init__(self, count, seed=0):
+        self.count = count
+        self.random = random.Random(seed)
+        self.now = START_TIME - 0.5 * PERIOD
+        self.pushes = []
+        self.push_times = []
+        self.stall_count = 0
+        self.done = threading.Event()
+        self.triggers = None
+
+    def clock(self):
+        return self.now
+
+    def wait(self, delay):
+        if len(self.pushes) >= self.count:
+            self.done.set()
+            return self.triggers.stop_event.wait()
+        self.now += delay + self.random.uniform(0, OVERSLEEP)
+        if self.random.random() < 0.02:
+            self.stall_count += 1
+            self.now += self.random.uniform(2 * PERIOD, MAX_STALL)
+        return False
+
+    def push(self, value, timestamp):
+        self.pushes.append((value, timestamp))
+        self.push_times.append(self.now)
+        self.now += self.random.uniform(0, PUSH_COST)
+
+def test_periodic_triggers_stay_on_grid():
+    time = SimulatedTime(TICK_COUNT)
+    triggers = PeriodicTriggers(time.push, first_value=5, value=1, period=PERIOD, clock=time.clock, wait=time.wait)
+    time.triggers = triggers
+    triggers.start(start_time=START_TIME)
+    thread = triggers.thread
+    assert time.done.wait(10)
+    triggers.stop()
+
+    assert not thread.is_alive()
+    assert triggers.thread is None
+    assert time.stall_count > 0
+    assert len(time.pushes) >= TICK_COUNT
+    values, stamps = zip(*time.pushes)
+    assert values[0] == 5
+    assert set(values[1:]) == {1}
+    # The exact grid, computed in rational arithmetic, so drift of any kind shows up.
+    expected = [float(Fraction(START_TIME) + n * Fraction(PERIOD)) for n in range(len(stamps))]
+    assert max(abs(stamp - reference) for stamp, reference in zip(stamps, expected)) < 1e-9
+    assert stamps[TICK_COUNT - 1] - stamps[0] == pytest.approx(3600 - PERIOD)
+
+    lateness = [push_time - stamp for push_time, stamp in zip(time.push_times, stamps)]
+    assert min(lateness) >= 0
+    # Stalls are caught up: lateness stays bounded and is no worse at the end of the hour than at the start.
+    assert max(lateness) <= MAX_LATENESS
+    quarter = len(lateness) // 4
+    medians = [statistics.median(lateness[start:start + quarter]) for start in range(0, 4 * quarter, quarter)]
+    assert max(medians) <= OVERSLEEP + 2 * PUSH_COST
+
+def test_stop_ends_waiting_thread():
+    triggers = PeriodicTriggers(lambda value, timestamp: None, first_value=5, period=3600)
+    triggers.start()
+    thread = triggers.thread
+    triggers.stop()
+    assert not thread.is_alive()
+    assert triggers.is_started()
+
+def test_period_must_be_positive():
+    with pytest.raises(ValueError):
+        PeriodicTriggers(lambda value, timestamp: None, first_value=5, period=0)
+
+def detect(detector, yaws, times):
+    # yaws of one body per frame, or (frames, bodies)
+    yaws = np.array(yaws, dtype=np.float64).reshape(len(yaws), -1)
+    frame_indices, values, crossing_times = detector.detect(yaws, times)
+    return frame_indices.tolist(), values.tolist(), crossing_times.tolist()
+
+def test_angle_crossing_is_interpolated():
+    frame_indices, values, crossing_times = detect(AngleTriggerDetector(1), [8, 12], [10.0, 10.4])
+    assert (frame_indices, values) == ([1], [10])
+    assert crossing_times == pytest.approx([10.2])
+
+def test_angle_crossing_down():
+    assert detect(AngleTriggerDetector(1), [-5, -15], [0, 1]) == ([1], [-10], [0.5])
+
+def test_angles_are_relative_to_starting_yaw():
+    assert detect(AngleTriggerDetector(1, starting_yaw=90), [95, 105], [0, 1]) == ([1], [10], [0.5])
+
+def test_angle_wraps_around_180():
+    # 175 to -175 is a 10 degree turn through 180, not 350 degrees back.
+    assert detect(AngleTriggerDetector(1), [175, -175], [0, 1]) == ([1], [180], [0.5])
+    assert detect(AngleTriggerDetector(1), [-175, 175], [0, 1]) == ([1], [180], [0.5])
+    frame_indices, values, _ = detect(AngleTriggerDetector(1), [170, -170, -155], [0, 1, 2])
+    assert values == [180, -170, -160]
+
+def test_angle_crossing_across_nan_frames():
+    frame_indices, values, crossing_times = detect(AngleTriggerDetector(1), [5, np.nan, np.nan, 25], [0, 1, 2, 3])
+    assert (frame_indices, values) == ([3, 3], [10, 20])
+    assert crossing_times == pytest.approx([0.75, 2.25])
+
+def test_several_thresholds_in_one_step():
+    frame_indices, values, crossing_times = detect(AngleTriggerDetector(1), [1, 31], [0, 3])
+    assert (frame_indices, values) == ([1, 1, 1], [10, 20, 30])
+    assert crossing_times == pytest.approx([0.9, 1.9, 2.9])
+
+def test_repeated_threshold_is_reported_once():
+    # Jitter around 10 reports it once, 20 is new, and 10 again after 20 is not a repeat.
+    frame_indices, values, _ = detect(AngleTriggerDetector(1), [9, 11, 9, 11, 21, 9], [0, 1, 2, 3, 4, 5])
+    assert (frame_indices, values) == ([1, 4, 5], [10, 20, 10])
+
+def test_angle_state_carries_across_batches():
+    detector = AngleTriggerDetector(1)
+    assert detect(detector, [5], [0]) == ([], [], [])
+    # The crossing lies between the last frame of the previous batch and frame 0 of this one.
+    assert detect(detector, [15], [1]) == ([0], [10], [0.5])
+    assert detect(detector, [np.nan, 25], [2, 3]) == ([1], [20], [2.0])
+    # The repeat filter also carries over.
+    assert detect(detector, [19, 21], [4, 5]) == ([], [], [])
+
+def test_batches_match_one_pass():
+    random_state = np.random.RandomState(0)
+    yaws = wrap_angle(np.cumsum(random_state.uniform(-8, 8, size=(500, 2)), axis=0))
+    yaws[random_state.rand(500) < 0.05, 0] = np.nan
+    times = np.arange(500) / 100
+    whole = detect(AngleTriggerDetector(2), yaws, times)
+    detector = AngleTriggerDetector(2)
+    parts = ([], [], [])
+    for start in range(0, 500, 37):
+        frame_indices, values, crossing_times = detect(detector, yaws[start:start + 37], times[start:start + 37])
+        parts[0].extend(index + start for index in frame_indices)
+        parts[1].extend(values)
+        parts[2].extend(crossing_times)
+    assert whole[0] == parts[0]
+    assert whole[1] == parts[1]
+    assert whole[2] == pytest.approx(parts[2])
+
+def test_crossings_of_all_bodies_in_time_order():
+    frame_indices, values, crossing_times = detect(AngleTriggerDetector(2), [[0, 0], [19, 39]], [0, 1])
+    assert values == [10, 20, 10, 30]
+    assert crossing_times == pytest.approx([10 / 39, 20 / 39, 10 / 19, 30 / 39])